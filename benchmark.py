@@ -0,0 +1,151 @@
+"""Times the game's hot paths on a generated level, printing the results as JSON so runs can be compared
+
+Simulation, catalog and level loading benchmarks run headless. The scene
+benchmarks open an offscreen window, load the models of every tile and
+play the level in a Game.
+"""
+
+import json, os, platform, random, sys, time
+from pathlib import Path
+from statistics import mean, median
+from typing import Callable, Dict, Optional
+
+from generate_level import write_level
+from level import compile_level, load_level
+from simulation import Simulation, TrackMap
+from tiles import catalog_dir, compile_catalog, tiles, Train
+
+
+# where generated levels are written, named after the parameters they were generated with
+benchmark_dir = Path('cache') / 'benchmark'
+
+
+def measure(func: Callable[[], object], repeat: int, setup: Optional[Callable[[], object]] = None) -> Dict[str, float]:
+    """Calls func repeat times, returning statistics of the time each call took in seconds
+
+    setup is called before each call without being timed.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat, 'mean': mean(times), 'median': median(times), 'min': min(times), 'max': max(times)}
+
+
+def benchmark_loading(path: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Times loading the tile catalogs and the level, both from their sources and from the cache"""
+    tile_list = tiles(None)
+    load_level(path, tile_list)
+    return {
+        'compile_catalog': measure(lambda: [compile_catalog(catalog) for catalog in catalog_dir.glob('*.tiles.json')], repeat),
+        'compile_level': measure(lambda: compile_level(path, tile_list), repeat),
+        'load_level': measure(lambda: load_level(path, tile_list), repeat),
+    }
+
+
+def benchmark_simulation(path: Path, frames: int) -> Dict[str, Dict[str, float]]:
+    """Times advancing the timeline and posing every train, one frame at a time at 60 frames per second
+
+    Trains are posed at the time the timeline has reached after each
+    update, as the game poses them.
+    """
+    level = load_level(path, tiles(None))
+    simulation = Simulation(TrackMap(level.track))
+    for x, y, _, train in level.trains:
+        simulation.add_train(train, x, y)
+    timeline = simulation.timeline
+    return {
+        'timeline_update': measure(lambda: timeline.update(1 / 60), frames),
+        'train_poses': measure(lambda: simulation.batch.move(timeline.timestamp), frames, setup=lambda: timeline.update(1 / 60)),
+    }
+
+
+def benchmark_scene(path: Path, repeat: int, frames: int) -> Dict[str, Dict[str, float]]:
+    """Times loading the tiles and their models and the level into a game, editing track, picking and drawing frames"""
+    from panda3d.core import loadPrcFileData, ModelPool, MouseWatcher, Point2
+    loadPrcFileData('', 'window-type offscreen\naudio-library-name null\nsync-video 0')
+    from main import chunk_of, config_dir, Game
+    from utils.mouse import MouseHandler
+
+    results = {}
+    start = time.perf_counter()
+    game = Game(path, config_dir / 'controls.ini')
+    game.mouseWatcherNode = MouseWatcher()
+    while not game.loaded:
+        game.task_mgr.step()
+    elapsed = time.perf_counter() - start
+    results['game_load'] = {'repeat': 1, 'mean': elapsed, 'median': elapsed, 'min': elapsed, 'max': elapsed}
+
+    # every model is loaded through the game's loader, as the tiles the game uses load theirs,
+    # with the model pool emptied first so each repeat reads the baked models again
+    def load_tiles():
+        for catalog in tiles(game).values():
+            for tile in catalog.values():
+                tile.node
+                if isinstance(tile, Train):
+                    tile.train
+    results['tiles'] = measure(load_tiles, repeat, setup=ModelPool.release_all_models)
+
+    # track is placed on and removed from clear cells in the chunks around the camera
+    tile_types = list(game.tile_list['tracks.png'].values())
+    cells = [cell for cell, clear in game.clear.items() if clear and cell not in game.track and chunk_of(*cell) in game.chunks]
+    rng = random.Random(0)
+    def edit_track():
+        cell = rng.choice(cells)
+        if cell in game.track:
+            del game.track[cell]
+        else:
+            game.track[cell] = rng.choice(tile_types)
+        game.update_track(cell)
+    results['update_track'] = measure(edit_track, repeat)
+
+    mouse = lambda: Point2(rng.uniform(-1, 1), rng.uniform(-2/3, 1))
+    picker = MouseHandler(game.camera, game.tile_nodes)
+    results['pick_node'] = measure(lambda: picker.pick_node(mouse()), repeat)
+    results['pick_cell'] = measure(lambda: game.mouse_handler.march(mouse()), repeat)
+
+    game.playing = True
+    game.set_speed(0)
+    results['frame'] = measure(game.task_mgr.step, frames)
+    return results
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=(64, 64), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('-l', '--loop-length', type=int, default=12, help='number of track pieces in each loop')
+    parser.add_argument('-t', '--trains', type=int, default=16, help='number of trains, each on its own loop')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='times each operation is timed')
+    parser.add_argument('-f', '--frames', type=int, default=600, help='frames simulated, of which a tenth are also drawn')
+    parser.add_argument('--headless', action='store_true', help='skip the benchmarks that need a window')
+    parser.add_argument('-o', '--output', type=Path, help='file to write the results to instead of standard output')
+    args = parser.parse_args()
+
+    width, height = args.size
+    path = benchmark_dir / f'level-{width}x{height}-l{args.loop_length}-t{args.trains}-s{args.seed}.tmx'
+    try:
+        write_level(path, width, height, args.loop_length, args.trains, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    results = {}
+    results.update(benchmark_loading(path, args.repeat))
+    results.update(benchmark_simulation(path, args.frames))
+    if not args.headless:
+        results.update(benchmark_scene(path, args.repeat, args.frames // 10))
+
+    report = {
+        'parameters': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        args.output.write_text(json.dumps(report, indent=2) + '\n')
@@ -0,0 +1,4 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<tileset version="1.4" tiledversion="1.4.2" name="tracks" tilewidth="128" tileheight="192" tilecount="56" columns="8">
+ <image source="tracks.png" width="1024" height="1344"/>
+</tileset>
@@ -0,0 +1,130 @@
+"""Writes synthetic levels of any size, covered in loops of track with a train on each, for benchmarking
+
+Each loop runs around a row of cells, so a loop of length n encloses
+(n - 4) / 2 cells and has straight track along its top and bottom where
+a train can start. Loops are laid out in rows across the level on clear
+ground, with random terrain everywhere else.
+"""
+
+import os, random
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+from xml.etree import ElementTree
+
+from tiles import left, right, sides, tiles, Tile, Track, Train
+
+
+data_dir = Path('data')
+
+# tile used for the ground under every loop, which must be clear
+ground_id = 16
+
+
+def loop_cells(x: int, y: int, length: int) -> List[Tuple[int, int]]:
+    """Returns the cells of a loop of the given length around a row of cells starting at x, y, in order of travel"""
+    if length < 8 or length % 2:
+        raise ValueError('loops must have an even length of at least 8')
+    inside = {(x + i, y) for i in range((length - 4) // 2)}
+    ring = {side(*cell) for cell in inside for side in sides} - inside
+
+    # every cell of the ring has exactly two neighbours in it, so the loop is a walk from any of them
+    cells = [min(ring)]
+    while len(cells) < len(ring):
+        cells.append(next(
+            cell for cell in (side(*cells[-1]) for side in sides)
+            if cell in ring and cell not in cells[-2:]
+        ))
+    return cells
+
+
+def loop_track(cells: List[Tuple[int, int]], catalog: Mapping[int, Tile], rng: random.Random) -> Dict[Tuple[int, int], int]:
+    """Returns a random track tile for each cell of a loop that connects it to the cells before and after it"""
+    track = {}
+    for i, cell in enumerate(cells):
+        ends = {side for side in sides if side(*cell) in (cells[i - 1], cells[(i + 1) % len(cells)])}
+        track[cell] = rng.choice([
+            tile_id for tile_id, tile in catalog.items()
+            if isinstance(tile, Track) and not isinstance(tile, Train) and {tile.src, tile.dst} == ends
+        ])
+    return track
+
+
+def generate_level(width: int, height: int, loop_length: int, trains: int, seed: int = 0) -> List[List[List[Optional[Tuple[str, int]]]]]:
+    """Returns the terrain and track layers of a level with a loop for each train
+
+    Each cell of a layer holds the name of a tileset image and the id of a
+    tile in it, as tile_loader gives them, or None if it is empty.
+    """
+    tile_list = tiles(None)
+    track_tiles = tile_list['tracks.png']
+    train_id = next(tile_id for tile_id, tile in tile_list['tileset.png'].items() if isinstance(tile, Train))
+    scenery = [tile_id for tile_id, tile in tile_list['tileset.png'].items() if not isinstance(tile, Track)]
+
+    rng = random.Random(seed)
+    terrain = [[('tileset.png', rng.choice(scenery)) for _ in range(width)] for _ in range(height)]
+    track = [[None] * width for _ in range(height)]
+
+    # loops are three rows high and length / 2 cells wide, with a gap of one cell between them
+    stride = loop_length // 2 + 1
+    across, down = width // stride, height // 4
+    if trains > across * down:
+        raise ValueError(f'only {across * down} loops of length {loop_length} fit in a {width} by {height} level')
+    for n in range(trains):
+        cells = loop_cells(2 + n % across * stride, 2 + n // across * 4, loop_length)
+        pieces = loop_track(cells, track_tiles, rng)
+        for (x, y), tile_id in pieces.items():
+            terrain[y][x] = 'tileset.png', ground_id
+            track[y][x] = 'tracks.png', tile_id
+        # the train starts on the first straight piece, which runs from left to right like the train tile
+        x, y = next(cell for cell in cells if {track_tiles[pieces[cell]].src, track_tiles[pieces[cell]].dst} == {left, right})
+        track[y][x] = 'tileset.png', train_id
+    return [terrain, track]
+
+
+def write_level(path: Path, width: int, height: int, loop_length: int, trains: int, seed: int = 0) -> None:
+    """Writes a generated level to a TMX file that uses the tilesets in the data directory"""
+    path = Path(path)
+    tilesets, first_gids, gid = [], {}, 1
+    for tileset in ('tileset.tsx', 'tracks.tsx'):
+        root = ElementTree.parse(data_dir / tileset).getroot()
+        tilesets.append(f' <tileset firstgid="{gid}" source="{Path(os.path.relpath(data_dir / tileset, path.parent)).as_posix()}"/>\n')
+        first_gids[Path(root.find('image').get('source')).name] = gid
+        gid += int(root.get('tilecount'))
+
+    layers = []
+    for layer_id, cells in enumerate(generate_level(width, height, loop_length, trains, seed), 1):
+        data = ',\n'.join(
+            ','.join('0' if cell is None else str(first_gids[cell[0]] + cell[1]) for cell in row)
+            for row in cells
+        )
+        layers.append(
+            f' <layer id="{layer_id}" name="Tile Layer {layer_id}" width="{width}" height="{height}">\n'
+            f'  <data encoding="csv">\n{data}\n</data>\n'
+            f' </layer>\n'
+        )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<map version="1.4" tiledversion="1.4.2" orientation="hexagonal" renderorder="right-down" width="{width}" height="{height}" '
+        f'tilewidth="128" tileheight="104" infinite="0" hexsidelength="52" staggeraxis="y" staggerindex="odd" nextlayerid="{len(layers) + 1}" nextobjectid="1">\n'
+        + ''.join(tilesets)
+        + ''.join(layers)
+        + '</map>\n'
+    )
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', type=Path)
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=(64, 64), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('-l', '--loop-length', type=int, default=12, help='number of track pieces in each loop')
+    parser.add_argument('-t', '--trains', type=int, default=16, help='number of trains, each on its own loop')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        write_level(args.output, *args.size, args.loop_length, args.trains, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
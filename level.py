@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import base64
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import partial
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, DefaultDict, Dict, List, Mapping, Optional, Tuple
+from xml.etree import ElementTree
+import zipfile
+import zlib
+
+import numpy as np
+from pytmx import TiledMap
+
+from rhythm import Target
+
+if TYPE_CHECKING:
+    from tiles import Tile, Track, Train
+
+
+# compiled levels, so level files are only parsed again when they change
+level_cache_dir = Path('cache') / 'levels'
+
+# version of the layout of compiled levels, so old ones are compiled again when it changes
+level_version = 2
+
+# arrays every compiled level holds
+level_arrays = ('tileset', 'tile', 'base', 'z', 'surface', 'terrain', 'clear', 'tilesets', 'properties', 'origin')
+
+
+@dataclass
+class Level:
+    """A Level is the contents of a level file, independent of any scene graph"""
+
+    width: int
+    height: int
+
+    properties: Mapping[str, str] = field(default_factory=dict)
+    """Custom properties of the map"""
+
+    terrain: List[Tuple[int, int, float, Tile]] = field(default_factory=list)
+    """Cell, height and type of each terrain tile, in the order they are stacked"""
+
+    trains: List[Tuple[int, int, float, Train]] = field(default_factory=list)
+    """Cell, height and type of each train"""
+
+    z: DefaultDict[Tuple[int, int], float] = field(default_factory=lambda: defaultdict(int))
+    """Height of the surface of each cell"""
+
+    clear: Dict[Tuple[int, int], bool] = field(default_factory=dict)
+    """Whether track can be placed on each cell"""
+
+    track: Dict[Tuple[int, int], Track] = field(default_factory=dict)
+    """Track tiles placed in the level, including the tiles trains start on"""
+
+    left: int = 0
+    top: int = 0
+    """Cell at the top left of the level, which is only away from (0, 0) for infinite maps"""
+
+    @property
+    def target(self) -> Optional[Target]:
+        """The target loop, given by the level as a period and comma separated beat times in seconds"""
+        if 'target_beats' not in self.properties:
+            return None
+        return Target(
+            period=float(self.properties['target_period']),
+            beats=tuple(sorted(float(beat) for beat in str(self.properties['target_beats']).split(','))),
+        )
+
+
+def tile_loader(filename, flags, tileset):
+    """An image loader for pytmx that refers to each tile of a tileset image by the image's name and the tile's id"""
+    filename = Path(filename).name
+    def inner(rect, flags):
+        x, y, w, h = rect
+        return filename, x // w + y // h * tileset.columns
+    return inner
+
+
+def read_chunked_map(path: Path) -> Tuple[int, int, int, int, List[List[Tuple[int, int, Tuple[str, int]]]], Dict[str, str]]:
+    """Reads an infinite map, which pytmx cannot, returning its bounds, the cells of each layer and its properties
+
+    Each layer of an infinite map is stored as chunks that can lie anywhere,
+    including at negative cells. The bounds cover every chunk of every layer.
+    """
+    root = ElementTree.parse(path).getroot()
+    tilesets = []
+    for tileset in root.findall('tileset'):
+        first_gid = int(tileset.get('firstgid'))
+        if tileset.get('source') is not None:
+            tileset = ElementTree.parse(Path(path).parent / tileset.get('source')).getroot()
+        tilesets.append((first_gid, Path(tileset.find('image').get('source')).name))
+    tilesets.sort()
+    first_gids = [first_gid for first_gid, _ in tilesets]
+
+    layers, bounds = [], []
+    for layer in root.iter('layer'):
+        data = layer.find('data')
+        cells = []
+        for chunk in data.findall('chunk'):
+            x, y, width, height = (int(chunk.get(name)) for name in ('x', 'y', 'width', 'height'))
+            bounds.append((x, y, x + width, y + height))
+            for i, gid in enumerate(decode_tiles(chunk.text, data.get('encoding'), data.get('compression'))):
+                # the top bits of a gid are flip and rotation flags
+                gid &= 0x0fffffff
+                if gid:
+                    first_gid, image = tilesets[bisect_right(first_gids, gid) - 1]
+                    cells.append((x + i % width, y + i // width, (image, gid - first_gid)))
+        layers.append(cells)
+
+    left, top = min((b[0] for b in bounds), default=0), min((b[1] for b in bounds), default=0)
+    right, bottom = max((b[2] for b in bounds), default=0), max((b[3] for b in bounds), default=0)
+    properties = {
+        prop.get('name'): prop.get('value', prop.text)
+        for prop in root.findall('properties/property')
+    }
+    return left, top, right - left, bottom - top, layers, properties
+
+
+def decode_tiles(text: str, encoding: Optional[str], compression: Optional[str]) -> List[int]:
+    """Returns the gids stored in the data of a layer or chunk"""
+    if encoding == 'csv':
+        return [int(gid) for gid in text.split(',') if gid.strip()]
+    if encoding == 'base64':
+        data = base64.b64decode(text.strip())
+        if compression in ('zlib', 'gzip'):
+            # accepts both zlib and gzip headers
+            data = zlib.decompress(data, zlib.MAX_WBITS | 32)
+        elif compression is not None:
+            raise ValueError(f'{compression} compressed layers are not supported')
+        return np.frombuffer(data, '<u4').tolist()
+    raise ValueError(f'{encoding} encoded layers are not supported')
+
+
+def compile_level(path: Path, tile_list: Mapping[str, Mapping[int, Tile]]) -> Dict[str, np.ndarray]:
+    """Reads a level file into grids of the tileset and tile id of each layer, along with the height and clear flag of each cell
+
+    base holds the height each tile is placed at, surface marks the cells
+    that have a height and terrain the cells that have a clear flag.
+    """
+    from tiles import Track, Train
+
+    if ElementTree.parse(path).getroot().get('infinite') == '1':
+        left, top, width, height, layers, properties = read_chunked_map(path)
+    else:
+        tiled_map = TiledMap(str(path), image_loader=tile_loader)
+        left, top, width, height = 0, 0, tiled_map.width, tiled_map.height
+        layers = [layer.tiles() for layer in tiled_map]
+        properties = dict(tiled_map.properties)
+
+    shape = len(layers), height, width
+    tilesets = {}
+    arrays = {
+        'tileset': np.full(shape, -1, np.int8),
+        'tile': np.zeros(shape, np.int16),
+        'base': np.zeros(shape, np.float64),
+        'z': np.zeros(shape[1:], np.float64),
+        'surface': np.zeros(shape[1:], bool),
+        'terrain': np.zeros(shape[1:], bool),
+        'clear': np.ones(shape[1:], bool),
+    }
+    for i, layer in enumerate(layers):
+        for x, y, (image, tile_id) in layer:
+            tile_type = tile_list[image][tile_id]
+            x, y = x - left, y - top
+            arrays['tileset'][i, y, x] = tilesets.setdefault(image, len(tilesets))
+            arrays['tile'][i, y, x] = tile_id
+            arrays['base'][i, y, x] = arrays['z'][y, x]
+            if isinstance(tile_type, Train) or not isinstance(tile_type, Track):
+                arrays['surface'][y, x] = True
+            if not isinstance(tile_type, Track):
+                arrays['z'][y, x] += tile_type.height
+                arrays['terrain'][y, x] = True
+                arrays['clear'][y, x] &= tile_type.clear
+
+    arrays['tilesets'] = np.array(list(tilesets))
+    arrays['properties'] = np.array(json.dumps(properties))
+    arrays['origin'] = np.array([left, top])
+    return arrays
+
+
+def compiled_path(path: Path, tile_list: Mapping[str, Mapping[int, Tile]]) -> Path:
+    """Returns where the compiled form of a level file is cached
+
+    The name depends on the level file, the tilesets next to it and the
+    height, clear flag and kind of every tile, so changing any of them
+    compiles the level again.
+    """
+    key = hashlib.sha256(Path(path).read_bytes())
+    for tileset in sorted(Path(path).parent.glob('*.tsx')):
+        key.update(tileset.read_bytes())
+    for image, catalog in sorted(tile_list.items()):
+        key.update(image.encode())
+        for name in ('kind', 'height', 'clear'):
+            key.update(catalog.arrays[name].tobytes())
+    key.update(repr(level_version).encode())
+    return level_cache_dir / f'{Path(path).stem}-{key.hexdigest()[:16]}.npz'
+
+
+def tile_kind(tile_type: Tile) -> int:
+    """Returns 0 for terrain, 1 for track and 2 for a train"""
+    from tiles import Track, Train
+    return 2 if isinstance(tile_type, Train) else 1 if isinstance(tile_type, Track) else 0
+
+
+def load_level(path: Path, tile_list: Mapping[str, Mapping[int, Tile]]) -> Level:
+    """Loads a level, compiling the level file first if it has changed since it was last compiled
+
+    A compiled level that is missing, truncated or damaged is compiled again.
+    """
+    compiled = compiled_path(path, tile_list)
+    try:
+        with np.load(compiled) as f:
+            arrays = {name: f[name] for name in level_arrays}
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        arrays = compile_level(path, tile_list)
+        try:
+            level_cache_dir.mkdir(parents=True, exist_ok=True)
+            # levels can be loaded by several processes at once, so each writes its own file first
+            partial_file = compiled.with_suffix(f'.{os.getpid()}.npz')
+            np.savez(partial_file, **arrays)
+            os.replace(partial_file, compiled)
+        except OSError:
+            pass
+
+    _, height, width = arrays['tileset'].shape
+    left, top = arrays['origin'].tolist()
+    level = Level(width, height, json.loads(str(arrays['properties'])), left=left, top=top)
+    catalogs = [tile_list[image] for image in arrays['tilesets'].tolist()]
+    for tilesets, tile_ids, bases in zip(arrays['tileset'], arrays['tile'], arrays['base']):
+        ys, xs = np.nonzero(tilesets >= 0)
+        # each distinct tile is looked up once, then the cells are split up by what kind of tile they hold
+        keys, inverse = np.unique(tilesets[ys, xs].astype(np.int32) << 16 | tile_ids[ys, xs], return_inverse=True)
+        types = [catalogs[key >> 16][key & 0xffff] for key in keys.tolist()]
+        cells = list(zip((xs + left).tolist(), (ys + top).tolist(), bases[ys, xs].tolist(), [types[i] for i in inverse.tolist()]))
+        for kind, cell in zip(np.array([tile_kind(t) for t in types], np.int8)[inverse].tolist(), cells):
+            if kind == 0:
+                level.terrain.append(cell)
+            else:
+                level.track[cell[:2]] = cell[3]
+                if kind == 2:
+                    level.trains.append(cell)
+
+    ys, xs = np.nonzero(arrays['surface'])
+    level.z.update(zip(zip((xs + left).tolist(), (ys + top).tolist()), arrays['z'][ys, xs].tolist()))
+    ys, xs = np.nonzero(arrays['terrain'])
+    level.clear.update(zip(zip((xs + left).tolist(), (ys + top).tolist()), arrays['clear'][ys, xs].tolist()))
+    return level
+
+
+def preload_steps(level: Level) -> List[Callable[[], object]]:
+    """Returns a step for each model a level uses, which loads it so none are loaded while the level is played
+
+    The levels of detail of terrain tiles are built as well, since chunks
+    are drawn from them. Steps use the model loader, so they must be run
+    on the main thread, but can be spread over several frames.
+    """
+    terrain = {tile_type for *_, tile_type in level.terrain}
+    steps = [partial(getattr, tile_type, 'lods') for tile_type in terrain]
+    steps += [
+        partial(getattr, tile_type, 'node')
+        for tile_type in {tile_type for *_, tile_type in level.trains} | set(level.track.values()) if tile_type not in terrain
+    ]
+    steps += [partial(getattr, train, 'train') for *_, train in level.trains]
+    return steps
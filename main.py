@@ -1,84 +1,119 @@
 
-import sys, random
+import math, sys, random, time
 from pathlib import Path
-from collections import defaultdict
 from configparser import ConfigParser
 
 from direct.showbase.ShowBase import ShowBase
 from direct.gui.OnscreenImage import OnscreenImage
+from direct.gui.OnscreenText import OnscreenText
 
 from panda3d.core import loadPrcFile
 from panda3d.core import AntialiasAttrib
 from panda3d.core import TransparencyAttrib
+from panda3d.core import LODNode, Point3, Vec3
+from panda3d.core import PStatClient, TextNode
 
-from pytmx import TiledMap
-
-from rhythm import Timeline
-from tiles import tiles, Track, Train, TrainInstance
+from level import load_level, preload_steps
+from rhythm import Scorer
+from simulation import Simulation, TrackMap
+from tiles import tiles
 from utils.lights import ambient_light, directional_light
 from utils.grid import from_hex, to_hex
-from utils.mouse import MouseHandler
+from utils.mouse import HeightFieldPicker
+from utils.timing import FrameTimer
 
 
 config_dir = Path('config')
 data_dir = Path('data')
+trace_dir = Path('traces')
 
 window = config_dir / 'window.prc'
 loadPrcFile(window)
 
+# playback speeds cycled through with fast_forward, None runs the timeline as fast as possible
+playback_speeds = [1, 2, 8, None]
+
+# real time in seconds spent simulating each frame when running as fast as possible
+fast_forward_budget = 1 / 120
+
+# time in seconds skipped by seek_back and seek_forward
+seek_step = 5.0
+
+# width and height in cells of the blocks static terrain is merged into
+chunk_size = 16
+
+# chunks on each side of the one the camera looks at that are kept in the scene
+stream_radius = 1
+
+# most chunks kept in the scene at once, beyond which the furthest are dropped
+max_chunks = 64
+
+# cells per second the camera pans
+pan_speed = 8
+
+# lowest and highest the camera can zoom to, and how many times higher it gets each second
+zoom_range = 4, 48
+zoom_speed = 2
+
+# camera distances beyond which terrain chunks switch to simplified models, then to flat impostors
+lod_distances = 24, 48
+
+# real time in seconds spent loading models each frame while the loading screen is shown
+preload_budget = 1 / 60
+
+# seconds between refreshes of the frame timing overlay
+timing_refresh = 0.25
+
+
+def chunk_of(x, y):
+    return x // chunk_size, y // chunk_size
+
 
 class Game(ShowBase):
-    def __init__(self, level, controls):
+    def __init__(self, level, controls, pstats=False):
         super().__init__()
 
+        # time is recorded per subsystem from the start of each frame, with drawing timed around igLoop
+        self.timer = FrameTimer()
+        self.task_mgr.add(self.start_frame, 'start_frame', sort=-100)
+        self.task_mgr.add(self.start_render, 'start_render', sort=49)
+        self.task_mgr.add(self.end_render, 'end_render', sort=51)
+        if pstats:
+            PStatClient.connect()
+
         self.set_background_color(33/255, 46/255, 56/255)
 
-        # set up timing system
-        self.timeline = Timeline()
+        # set up simulation and timing system
+        self.track = TrackMap()
+        self.simulation = Simulation(self.track)
+        self.timeline = self.simulation.timeline
         self.timeline.speed = 0
         self.last_time = 0.0
 
         self.tile_list = tiles(self)
 
-        def extract_tile(filename, flags, tileset):
-            filename = Path(filename).name
-            tiles = self.tile_list[filename]
-            def inner(rect, flags):
-                x, y, w, h = rect
-                return tiles[x // w + y // h * tileset.columns]
-            return inner
-
-        tiled_map = TiledMap(level, image_loader=extract_tile)
         self.level = self.render.attach_new_node("level")
         self.tile_nodes = self.level.attach_new_node("tiles")
-        width = tiled_map.width
-        height = tiled_map.height * 3**0.5 / 2
-        self.level.set_pos(width / 2, -height / 2, 0)
-
-        self.z = defaultdict(int)
-        self.track = {}
-        self.clear = {}
+        self.track_nodes = self.level.attach_new_node("track")
+        self.track_tiles = {}
+        self.chunks = {}
         self.trains = []
-        for layer in tiled_map:
-            for x, y, tile_type in layer.tiles():
-                if tile_type is not None:
-                    if isinstance(tile_type, Train):
-                        train_node = tile_type.train.copyTo(self.level)
-                        train_node.set_pos(*from_hex(x, y), self.z[x, y])
-                        self.trains.append(TrainInstance(tile_type, train_node, x, y))
-                    if isinstance(tile_type, Track):
-                        self.track[x, y] = tile_type
-                    else:
-                        tile = self.tile_nodes.attach_new_node("tile")
-                        tile.set_pos(*from_hex(x, y), self.z[x, y])
-                        self.z[x, y] += tile_type.height
-                        self.clear[x, y] = self.clear.get((x, y), True) and tile_type.clear
-                        tile_type.node.instanceTo(tile)
-
-        self.track_nodes = None
-        self.update_track()
-
-        self.timeline.subscribe(self.update_trains)
+        self.z = {}
+        self.clear = {}
+        self.scorer = None
+
+        # the level file is read on a separate thread while the loading screen is drawn, then models
+        # are loaded a few at a time and the scene is built a chunk at a time on the main thread,
+        # since the model loader is not safe to use from other threads while frames are drawn
+        self.loaded = False
+        self.loading_progress = 0.0
+        self.loading_error = None
+        self.pending_level = None
+        self.preload_steps = []
+        self.preloaded = 0
+        self.terrain_chunks = {}
+        self.task_mgr.setupTaskChain('loading', numThreads=1)
+        self.task_mgr.add(self.read_level, 'read_level', taskChain='loading', extraArgs=[level])
 
         # use antialiasing
         self.render.set_antialias(AntialiasAttrib.MMultisample)
@@ -118,8 +153,22 @@ class Game(ShowBase):
             pos=(-0.9 * aspect_ratio, 0, 0.85), scale=0.08, parent=self.aspect2d)
         self.stop.setTransparency(TransparencyAttrib.MAlpha)
         self.stop.hide()
+        self.speed_label = OnscreenText(text='',
+            pos=(-0.9 * aspect_ratio + 0.2, 0.83), scale=0.07, fg=(1, 1, 1, 1), parent=self.aspect2d, mayChange=True)
+        self.speed_label.hide()
+        self.score_label = OnscreenText(text='',
+            pos=(0.9 * aspect_ratio - 0.1, 0.83), scale=0.07, fg=(1, 1, 1, 1), parent=self.aspect2d, mayChange=True)
+        self.score_label.hide()
+        self.loading_label = OnscreenText(text='Loading 0%',
+            pos=(0, 0), scale=0.1, fg=(1, 1, 1, 1), parent=self.aspect2d, mayChange=True)
+        self.timing_label = OnscreenText(text='',
+            pos=(0.95 * aspect_ratio, 0.7), scale=0.045, fg=(1, 1, 1, 1), bg=(0, 0, 0, .5), align=TextNode.ARight,
+            parent=self.aspect2d, mayChange=True)
+        self.timing_label.hide()
+        self.timing_refreshed = 0.0
 
         self.playing = False
+        self.speed = 0
 
         track_id_to_thumb = {
             1: 'straight_1-2-3-4.png',
@@ -148,35 +197,143 @@ class Game(ShowBase):
         self.rotating_cw = False
         self.rotating_ccw = False
 
-        self.mouse_handler = MouseHandler(self.camera, self.tile_nodes)
-
-    def update_track(self):
-        if self.track_nodes is not None:
-            self.track_nodes.removeNode()
-        self.track_nodes = self.level.attach_new_node("track")
-        for (x, y), tile_type in self.track.items():
-            if tile_type is not None:
+        self.mouse_handler = None
+
+    def read_level(self, path):
+        """Reads a level, lists the models it uses and groups its terrain into chunks"""
+        try:
+            level = load_level(path, self.tile_list)
+        except Exception as e:
+            self.loading_error = e
+            return
+
+        for x, y, z, tile_type in level.terrain:
+            self.terrain_chunks.setdefault(chunk_of(x, y), []).append((x, y, z, tile_type))
+        self.preload_steps = preload_steps(level)
+        self.pending_level = level
+
+    def build_level(self):
+        """Loads the next few models, or adds the next chunk around the camera to the scene and everything else once they are all built"""
+        if self.preloaded < len(self.preload_steps):
+            deadline = time.perf_counter() + preload_budget
+            while self.preloaded < len(self.preload_steps) and time.perf_counter() < deadline:
+                self.preload_steps[self.preloaded]()
+                self.preloaded += 1
+            self.loading_progress = self.preloaded / len(self.preload_steps) / 2
+            return
+
+        level = self.pending_level
+        if not self.chunks:
+            self.level.set_pos(level.left + level.width / 2, -(level.top + level.height / 2) * 3**0.5 / 2, 0)
+            self.z = level.z
+            self.clear = level.clear
+
+        if self.stream_chunks():
+            self.loading_progress = 0.5 + len(self.chunks) / (2 * stream_radius + 1)**2 / 2
+            return
+
+        self.track.update(level.track)
+        self.update_track(*self.track)
+
+        for x, y, z, tile_type in level.trains:
+            train_node = tile_type.train.copyTo(self.level)
+            train_node.set_pos(*from_hex(x, y), z)
+            self.simulation.add_train(tile_type, x, y)
+            self.trains.append(train_node)
+
+        target = level.target
+        self.scorer = Scorer(target) if target is not None else None
+
+        self.mouse_handler = HeightFieldPicker(self.camera, self.tile_nodes, self.z)
+        self.loading_label.hide()
+        self.pending_level = None
+        self.preload_steps = []
+        self.loaded = True
+
+    def focus(self):
+        """Returns the chunk containing the cell in the middle of the view"""
+        origin = self.level.get_relative_point(self.camera, Point3(0, 0, 0))
+        direction = self.level.get_relative_vector(self.camera, Vec3(0, 1, 0))
+        point = origin - direction * (origin.z / direction.z)
+        return chunk_of(*to_hex(point.x, point.y))
+
+    def stream_chunks(self):
+        """Builds the nearest missing chunk around the camera and drops chunks too far from it, returning whether one was built
+
+        Only the scene is streamed, the simulation always covers the whole level.
+        """
+        fx, fy = self.focus()
+        distance = lambda chunk: max(abs(chunk[0] - fx), abs(chunk[1] - fy))
+        # a higher camera sees more of the level
+        radius = max(stream_radius, math.ceil(self.camera.get_z() / chunk_size))
+        missing = [
+            (fx + dx, fy + dy)
+            for dx in range(-radius, radius + 1)
+            for dy in range(-radius, radius + 1)
+            if (fx + dx, fy + dy) not in self.chunks
+        ]
+        if missing:
+            self.build_chunk(min(missing, key=distance))
+
+        # chunks just outside the radius are kept so panning back and forth does not rebuild them
+        loaded = sorted(self.chunks, key=distance)
+        for n, chunk in enumerate(loaded):
+            if distance(chunk) > radius + 1 or n >= max_chunks:
+                self.drop_chunk(chunk)
+        return bool(missing)
+
+    def build_chunk(self, cell):
+        # each level of detail of a chunk is flattened into as few geoms as possible, since terrain never changes
+        terrain = self.terrain_chunks.get(cell, ())
+        lod = LODNode("chunk")
+        chunk = self.chunks[cell] = self.tile_nodes.attach_new_node(lod)
+        lod.set_center(Point3(*from_hex((cell[0] + 0.5) * chunk_size, (cell[1] + 0.5) * chunk_size), 0))
+        for i, (near, far) in enumerate(zip((0, *lod_distances), (*lod_distances, float('inf')))):
+            detail = chunk.attach_new_node("detail")
+            for x, y, z, tile_type in terrain:
+                tile = detail.attach_new_node("tile")
+                tile.set_pos(*from_hex(x, y), z)
+                tile_type.lods[i].copy_to(tile)
+            # flattening stops at the root node of each model, so they are removed to let tiles merge
+            detail.clear_model_nodes()
+            detail.flattenStrong()
+            lod.add_switch(far, near)
+        self.update_track(*(track for track in self.track if chunk_of(*track) == cell))
+
+    def drop_chunk(self, cell):
+        self.chunks.pop(cell).removeNode()
+        for track in [track for track in self.track_tiles if chunk_of(*track) == cell]:
+            self.track_tiles.pop(track).removeNode()
+
+    def update_track(self, *cells):
+        """Replaces the nodes of the given cells with ones for the track now on them"""
+        for x, y in cells:
+            tile = self.track_tiles.pop((x, y), None)
+            if tile is not None:
+                tile.removeNode()
+            tile_type = self.track.get((x, y))
+            # track outside the streamed chunks gets a node when its chunk is built
+            if tile_type is not None and chunk_of(x, y) in self.chunks:
                 tile = self.track_nodes.attach_new_node("tile")
                 tile.set_pos(*from_hex(x, y), self.z[x, y])
                 tile_type.node.instanceTo(tile)
+                self.track_tiles[x, y] = tile
 
-    def update_trains(self, old, new):
-        return [
-            beat
-            for train in self.trains
-            for beat in train.update(old, new, self.track)
-        ]
+    def update_trains(self):
+        # every train is posed at once, and only the nodes of those that moved are touched
+        moved, poses = self.simulation.batch.move(self.timeline.timestamp)
+        for i, (x, y, angle) in zip(moved.tolist(), poses.tolist()):
+            train = self.trains[i]
+            train.set_pos_hpr(x, y, train.get_z(), 60, 90, angle)
 
     def handle_mouse_move(self):
         mpos = self.mouseWatcherNode.getMouse()
-        pickedObj = self.mouse_handler.pick_node(mpos)
-        if pickedObj is not None:
-            tile = pickedObj.parent.parent.parent
-            x, y, z = tile.get_pos()
-            tile_x, tile_y = to_hex(x, y)
+        cell = self.mouse_handler.pick_cell(mpos)
+        if cell is not None and cell in self.clear:
+            tile_x, tile_y = cell
             self.mouse_tile_coords = tile_x, tile_y
             if mpos.y >= -2/3 and self.selected_thumb is not None and self.clear[tile_x, tile_y] and self.track.get((tile_x, tile_y)) is None and not self.playing:
-                self.preview.setPos(x, y, self.z[tile_x, tile_y])
+                self.preview.setPos(*from_hex(tile_x, tile_y), self.z[tile_x, tile_y])
                 self.preview.show()
             else:
                 self.preview.hide()
@@ -192,6 +349,13 @@ class Game(ShowBase):
                 self.tile_list['tracks.png'][self.selected_thumb].node.instanceTo(self.preview)
 
 
+    def set_speed(self, index):
+        self.speed = index % len(playback_speeds)
+        speed = playback_speeds[self.speed]
+        self.timeline.speed = 1 if speed is None else speed
+        self.speed_label.setText('max' if speed is None else f'{speed}x')
+
+
     def handle_mouse_click(self):
         scale, aspect_ratio = .15, self.get_aspect_ratio()
         mpos = self.mouseWatcherNode.getMouse()
@@ -202,13 +366,23 @@ class Game(ShowBase):
                 self.stop.show()
                 self.tile_tray.hide()
                 self.preview.hide()
-                self.timeline.speed = 1
+                self.speed_label.show()
+                if self.scorer is not None:
+                    self.scorer.reset(self.timeline.timestamp)
+                    self.score_label.show()
+                self.set_speed(0)
+                # the track may have been edited since the trains were last scheduled
+                self.timeline.reschedule()
             else:
                 self.play.show()
                 self.stop.hide()
                 self.tile_tray.show()
+                self.speed_label.hide()
+                self.score_label.hide()
                 self.timeline.speed = 0
                 self.timeline.reset()
+                if self.scorer is not None:
+                    self.scorer.reset()
         elif not self.playing:
             if mpos.y < -2/3:
                 # handle tile tray clicked
@@ -222,7 +396,7 @@ class Game(ShowBase):
                     tile_x, tile_y = self.mouse_tile_coords
                     if self.clear[tile_x, tile_y] and self.track.get((tile_x, tile_y)) is None:
                         self.track[tile_x, tile_y] = self.tile_list['tracks.png'][self.selected_thumb]
-                        self.update_track()
+                        self.update_track((tile_x, tile_y))
 
 
     def handle_mouse_alt_click(self):
@@ -234,7 +408,7 @@ class Game(ShowBase):
                 tile = self.track.get((tile_x, tile_y))
                 if tile is not None and tile.removable:
                     del self.track[tile_x, tile_y]
-                    self.update_track()
+                    self.update_track((tile_x, tile_y))
         self.select(None)
 
 
@@ -253,32 +427,126 @@ class Game(ShowBase):
             self.accept(key + '-up', self.actions.update, [{action: False}])
 
 
+    def start_frame(self, task):
+        self.timer.new_frame()
+        return task.cont
+
+    def start_render(self, task):
+        self.timer.begin('render')
+        return task.cont
+
+    def end_render(self, task):
+        self.timer.end('render')
+        return task.cont
+
+    def update_timings(self, now):
+        """Shows the mean and worst time each subsystem took per frame over the recorded frames"""
+        if now - self.timing_refreshed < timing_refresh:
+            return
+        self.timing_refreshed = now
+        self.timing_label.setText('\n'.join(
+            f'{name} {mean * 1000:.1f} ms, worst {worst * 1000:.1f} ms'
+            for name, (mean, worst) in self.timer.summary().items()
+        ))
+
     def loop(self, task):
+        if self.immediate_actions['show_timings'] > 0:
+            if self.timing_label.isHidden():
+                self.timing_label.show()
+            else:
+                self.timing_label.hide()
+        self.immediate_actions['show_timings'] = 0
+        if not self.timing_label.isHidden():
+            self.update_timings(task.time)
+
+        if self.immediate_actions['export_trace'] > 0:
+            self.timer.export(trace_dir / f'trace-{time.strftime("%Y%m%d-%H%M%S")}.json')
+            self.immediate_actions['export_trace'] = 0
+
+        if not self.loaded:
+            if self.loading_error is not None:
+                raise self.loading_error
+            if self.pending_level is not None:
+                with self.timer.scope('loading'):
+                    self.build_level()
+            self.loading_label.setText(f'Loading {self.loading_progress:.0%}')
+            self.last_time = task.time
+            return task.cont
+
+        with self.timer.scope('camera'):
+            # pan along the ground in the directions the camera faces
+            right = self.render.get_relative_vector(self.camera, Vec3(1, 0, 0))
+            forward = self.render.get_relative_vector(self.camera, Vec3(0, 1, 0))
+            right.z = forward.z = 0
+            pan = right.normalized() * (self.actions['pan_right'] - self.actions['pan_left'])
+            pan += forward.normalized() * (self.actions['pan_up'] - self.actions['pan_down'])
+            if pan.length_squared() > 0:
+                self.camera.set_pos(self.camera.get_pos() + pan * pan_speed * (task.time - self.last_time))
+
+            # zoom along the line of sight, keeping the same point in the middle of the view
+            zoom = self.actions['zoom_out'] - self.actions['zoom_in']
+            if zoom != 0:
+                height = self.camera.get_z()
+                new_height = min(max(height * zoom_speed**(zoom * (task.time - self.last_time)), zoom_range[0]), zoom_range[1])
+                forward = self.render.get_relative_vector(self.camera, Vec3(0, 1, 0))
+                self.camera.set_pos(self.camera.get_pos() + forward * ((height - new_height) / -forward.z))
+
+        with self.timer.scope('streaming'):
+            self.stream_chunks()
+
         if self.mouseWatcherNode.hasMouse():
-            self.handle_mouse_move()
-            if self.immediate_actions['interact'] > 0:
-                self.handle_mouse_click()
-                self.immediate_actions['interact'] = 0
-            if self.immediate_actions['cancel'] > 0:
-                self.handle_mouse_alt_click()
-                self.immediate_actions['cancel'] = 0
+            with self.timer.scope('picking'):
+                self.handle_mouse_move()
+            with self.timer.scope('scene edits'):
+                if self.immediate_actions['interact'] > 0:
+                    self.handle_mouse_click()
+                    self.immediate_actions['interact'] = 0
+                if self.immediate_actions['cancel'] > 0:
+                    self.handle_mouse_alt_click()
+                    self.immediate_actions['cancel'] = 0
 
 
         if self.immediate_actions['exit'] > 0:
             sys.exit()
 
-        while self.immediate_actions['rotate_cw'] > 0:
-            if self.selected_thumb is not None:
-                self.select(self.tile_list['tracks.png'][self.selected_thumb].rotate_cw)
-            self.immediate_actions['rotate_cw'] -= 1
+        with self.timer.scope('scene edits'):
+            while self.immediate_actions['rotate_cw'] > 0:
+                if self.selected_thumb is not None:
+                    self.select(self.tile_list['tracks.png'][self.selected_thumb].rotate_cw)
+                self.immediate_actions['rotate_cw'] -= 1
 
-        while self.immediate_actions['rotate_ccw'] > 0:
-            if self.selected_thumb is not None:
-                self.select(self.tile_list['tracks.png'][self.selected_thumb].rotate_ccw)
-            self.immediate_actions['rotate_ccw'] -= 1
+            while self.immediate_actions['rotate_ccw'] > 0:
+                if self.selected_thumb is not None:
+                    self.select(self.tile_list['tracks.png'][self.selected_thumb].rotate_ccw)
+                self.immediate_actions['rotate_ccw'] -= 1
+
+        if self.immediate_actions['fast_forward'] > 0:
+            if self.playing:
+                self.set_speed(self.speed + self.immediate_actions['fast_forward'])
+            self.immediate_actions['fast_forward'] = 0
+
+        with self.timer.scope('simulation'):
+            seek = self.immediate_actions['seek_forward'] - self.immediate_actions['seek_back']
+            if seek != 0 and self.playing:
+                self.timeline.seek(max(0.0, self.timeline.timestamp + seek * seek_step))
+                if self.scorer is not None:
+                    self.scorer.reset(self.timeline.timestamp)
+            self.immediate_actions['seek_forward'] = 0
+            self.immediate_actions['seek_back'] = 0
+
+            if self.playing and playback_speeds[self.speed] is None:
+                beats = self.timeline.fast_forward(fast_forward_budget)
+            else:
+                beats = self.timeline.update(task.time - self.last_time)
+            self.last_time = task.time
+
+        with self.timer.scope('trains'):
+            self.update_trains()
 
-        self.timeline.update(task.time - self.last_time)
-        self.last_time = task.time
+        if self.scorer is not None and self.playing:
+            with self.timer.scope('scoring'):
+                match = self.scorer.update(beats, self.timeline.timestamp)
+                self.score_label.setText(f'{match.score:.0%}')
 
         return task.cont
 
@@ -294,5 +562,6 @@ if __name__ == '__main__':
         '-c', '--controls',
         default=config_dir / 'controls.ini',
     )
+    parser.add_argument('--pstats', action='store_true', help='send frame timings to a running PStats server')
     game = Game(**vars(parser.parse_args()))
     game.run()
@@ -1,5 +1,11 @@
+from bisect import bisect_right
 from dataclasses import dataclass, field
-from typing import List, Callable, Sequence
+import heapq
+import itertools
+import time
+from typing import Any, Iterator, List, Callable, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 @dataclass(frozen=True)
 class Beat:
@@ -10,6 +16,100 @@ class Beat:
     """Id of train that produced the beat"""
 
 
+class BeatLog:
+    """A BeatLog stores beats in order of timestamp in typed columns, keeping only the most recent capacity beats"""
+
+    def __init__(self, capacity: int = 1 << 16):
+        self.capacity = capacity
+        """Maximum number of beats kept"""
+
+        self.total = 0
+        """Number of beats added and not truncated, including those dropped to stay within capacity"""
+
+        # beats live in [start, end) of buffers twice the capacity, which are
+        # compacted back to the front when full so every view is contiguous
+        self._timestamps = np.empty(2 * capacity, dtype=np.float64)
+        self._trains = np.empty(2 * capacity, dtype=np.int32)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Beat, List[Beat]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('beat index out of range')
+        index += self._start
+        return Beat(float(self._timestamps[index]), int(self._trains[index]))
+
+    def __iter__(self) -> Iterator[Beat]:
+        for timestamp, train in zip(self.timestamps.tolist(), self.trains.tolist()):
+            yield Beat(timestamp, train)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        """Timestamps of the kept beats"""
+        return self._timestamps[self._start:self._end]
+
+    @property
+    def trains(self) -> np.ndarray:
+        """Train ids of the kept beats"""
+        return self._trains[self._start:self._end]
+
+    def extend(self, beats: Sequence[Beat]) -> None:
+        """Adds beats, which must be sorted and no earlier than those already in the log"""
+        count = len(beats)
+        if count == 0:
+            return
+        self.total += count
+        if count > self.capacity:
+            beats = beats[-self.capacity:]
+            count = self.capacity
+        if self._end + count > len(self._timestamps):
+            keep = min(len(self), self.capacity - count)
+            self._timestamps[:keep] = self._timestamps[self._end - keep:self._end]
+            self._trains[:keep] = self._trains[self._end - keep:self._end]
+            self._start, self._end = 0, keep
+        self._timestamps[self._end:self._end + count] = [beat.timestamp for beat in beats]
+        self._trains[self._end:self._end + count] = [beat.train for beat in beats]
+        self._end += count
+        self._start = max(self._start, self._end - self.capacity)
+
+    def truncate(self, timestamp: float) -> None:
+        """Drops the beats after the given time"""
+        end = self._start + int(np.searchsorted(self.timestamps, timestamp, side='right'))
+        self.total -= self._end - end
+        self._end = end
+
+    def clear(self) -> None:
+        self.total = 0
+        self._start = self._end = 0
+
+    def between(self, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns views of the timestamps and train ids of the kept beats in (start, end]"""
+        timestamps = self.timestamps
+        lo, hi = np.searchsorted(timestamps, (start, end), side='right')
+        return timestamps[lo:hi], self.trains[lo:hi]
+
+    def train(self, train: int, start: float = -np.inf, end: float = np.inf) -> np.ndarray:
+        """Returns the timestamps of the kept beats in (start, end] produced by the given train"""
+        timestamps, trains = self.between(start, end)
+        return timestamps[trains == train]
+
+
+@dataclass(frozen=True, order=True)
+class Checkpoint:
+    timestamp: float
+    """Time in seconds when the checkpoint was saved"""
+
+    states: Tuple[Any, ...] = field(compare=False)
+    """Saved state of each stateful subscriber"""
+
+
 @dataclass
 class Timeline:
     timestamp: float = 0.0
@@ -21,24 +121,215 @@ class Timeline:
     subscribers: List[Callable[[float, float], List[Beat]]] = field(default_factory=list)
     """List of update methods taking start and end times of update and returning any beats that were produced during the update"""
 
-    beats: List[Beat] = field(default_factory=list)
+    beats: BeatLog = field(default_factory=BeatLog)
+    """Most recent beats produced by the timeline"""
+
+    savers: List[Tuple[Callable[[], Any], Callable[[Any], None]]] = field(default_factory=list)
+    """Pairs of methods saving and restoring the state of stateful subscribers"""
+
+    checkpoint_interval: float = 1.0
+    """Time in seconds between checkpoints, doubled whenever the number of checkpoints exceeds max_checkpoints"""
+
+    max_checkpoints: int = 256
+    """Maximum number of checkpoints kept"""
+
+    checkpoints: List[Checkpoint] = field(default_factory=list)
+    """Saved subscriber states in order of timestamp"""
+
+    next_events: List[Optional[Callable[[float], float]]] = field(default_factory=list)
+    """For each subscriber, a method returning the first time after the given time at which it needs updating, or None if it is updated every time"""
+
+    _last: List[float] = field(default_factory=list, repr=False)
+    _polled: List[int] = field(default_factory=list, repr=False)
+    _queue: Optional[List[Tuple[float, int]]] = field(default=None, repr=False)
 
     def reset(self) -> None:
         self.timestamp = 0.0
         for subscriber in self.subscribers:
             subscriber(0.0, 0.0)
-        self.beats = []
+        self.beats.clear()
+        self.checkpoints = []
+        self.reschedule()
 
-    def subscribe(self, subscriber: Callable[[float, float], List[Beat]]) -> None:
+    def subscribe(self, subscriber: Callable[[float, float], List[Beat]],
+        save: Optional[Callable[[], Any]] = None, restore: Optional[Callable[[Any], None]] = None,
+        next_event: Optional[Callable[[float], float]] = None) -> None:
+        """Adds a subscriber, with optional methods to save and restore its state so the timeline can seek
+
+        If next_event is given the subscriber is only updated once the
+        timeline passes the time it returns, and otherwise on every update.
+        Subscribers must return their beats sorted by timestamp.
+        """
         self.subscribers.append(subscriber)
+        self.next_events.append(next_event)
+        if save is not None and restore is not None:
+            self.savers.append((save, restore))
+        self.reschedule()
+
+    def reschedule(self) -> None:
+        """Asks every subscriber for its next event again, which is needed whenever their state changes outside of an update"""
+        self._last = [self.timestamp] * len(self.subscribers)
+        self._polled = [i for i, next_event in enumerate(self.next_events) if next_event is None]
+        self._queue = None
+
+    def checkpoint(self) -> None:
+        """Saves the state of all stateful subscribers at the current time"""
+        self.checkpoints.append(Checkpoint(
+            self.timestamp,
+            tuple(save() for save, _ in self.savers),
+        ))
+        if len(self.checkpoints) > self.max_checkpoints:
+            # keep memory bounded by halving the resolution, the first checkpoint is always kept
+            self.checkpoints = self.checkpoints[::2]
+            self.checkpoint_interval *= 2
+
+    def seek(self, timestamp: float) -> None:
+        """Moves the timeline to the given time by restoring the nearest checkpoint before it and simulating the remainder
+
+        Checkpoints are only valid for the subscribers as they were when saved,
+        so the timeline should be reset after changing them.
+        """
+        index = bisect_right(self.checkpoints, Checkpoint(timestamp, ())) - 1
+        if index >= 0 and not self.checkpoints[index].timestamp <= self.timestamp <= timestamp:
+            checkpoint = self.checkpoints[index]
+            for (_, restore), state in zip(self.savers, checkpoint.states):
+                restore(state)
+            self.timestamp = checkpoint.timestamp
+            # everything after the restored checkpoint is simulated again, so later checkpoints and beats are stale
+            del self.checkpoints[index + 1:]
+            self.beats.truncate(checkpoint.timestamp)
+            self.reschedule()
+        elif timestamp < self.timestamp:
+            self.reset()
+        self.advance(timestamp)
 
     def update(self, dt: float) -> Sequence[Beat]:
-        old = self.timestamp
-        new = self.timestamp + dt * self.speed
+        return self.advance(self.timestamp + dt * self.speed)
+
+    def fast_forward(self, budget: float, step: float = 1.0) -> Sequence[Beat]:
+        """Advances the timeline in steps of step seconds, ignoring speed, until budget seconds of real time have passed"""
+        deadline = time.perf_counter() + budget
         new_beats = []
-        for subscriber in self.subscribers:
-            new_beats += subscriber(old, new)
-        new_beats = sorted(new_beats, key=lambda beat: beat.timestamp)
-        self.beats += new_beats
+        while time.perf_counter() < deadline:
+            new_beats += self.advance(self.timestamp + step)
+        return new_beats
+
+    def advance(self, new: float) -> Sequence[Beat]:
+        if not self.checkpoints:
+            self.checkpoint()
+        if self._queue is None:
+            self._queue = [
+                (next_event(self.timestamp), i)
+                for i, next_event in enumerate(self.next_events)
+                if next_event is not None
+            ]
+            heapq.heapify(self._queue)
+
+        # wake subscribers whose next event falls in (timestamp, new], which never includes idle ones
+        woken = []
+        while self._queue and self._queue[0][0] <= new:
+            woken.append(heapq.heappop(self._queue)[1])
+        outputs = []
+        for i in itertools.chain(self._polled, woken):
+            outputs.append(self.subscribers[i](self._last[i], new))
+            self._last[i] = new
+        for i in woken:
+            heapq.heappush(self._queue, (self.next_events[i](new), i))
+
+        new_beats = list(heapq.merge(*outputs, key=lambda beat: beat.timestamp))
+        self.beats.extend(new_beats)
         self.timestamp = new
+        if new >= self.checkpoints[-1].timestamp + self.checkpoint_interval:
+            self.checkpoint()
         return new_beats
+
+
+@dataclass(frozen=True)
+class Target:
+    """A Target is the loop of beats the player is trying to reproduce"""
+
+    period: float
+    """Length of the loop in seconds"""
+
+    beats: Tuple[float, ...]
+    """Sorted times of the beats within the loop, in [0, period)"""
+
+
+@dataclass(frozen=True)
+class Match:
+    score: float
+    """How well the beats match the target, from 0 for no match to 1 for a perfect match"""
+
+    phase: float
+    """Time in seconds at which the best fitting repetition of the target starts, in [0, period)"""
+
+    matched: int
+    """Number of beats within tolerance of a target beat"""
+
+
+def match(timestamps: np.ndarray, start: float, end: float, target: Target, tolerance: float) -> Match:
+    """Aligns the sorted beat timestamps in (start, end] against the target at the phase that fits best
+
+    The score is the harmonic mean of the fraction of beats that hit a target
+    beat and the fraction of target beats in the window that were hit. Beats
+    closer together than the tolerance, such as two tiles beating at the
+    boundary between them, count as one.
+    """
+    period = target.period
+    pattern = np.asarray(target.beats, dtype=np.float64)
+    if len(timestamps) > 1:
+        timestamps = timestamps[np.concatenate(([True], np.diff(timestamps) > tolerance))]
+    if len(timestamps) == 0 or len(pattern) == 0:
+        return Match(float(len(timestamps) == len(pattern)), 0.0, 0)
+
+    # every pairing of a beat with a target beat proposes a phase
+    phases = np.unique((timestamps[:, None] - pattern[None, :]) % period)
+
+    # distance from each beat to the nearest target beat, for each phase
+    offsets = (timestamps[:, None] - phases[None, :]) % period
+    wrapped = np.concatenate(([pattern[-1] - period], pattern, [pattern[0] + period]))
+    index = np.searchsorted(wrapped, offsets)
+    distance = np.minimum(offsets - wrapped[index - 1], wrapped[index] - offsets)
+    hits = np.count_nonzero(distance <= tolerance, axis=0)
+
+    # number of target beats that fall in the window, for each phase
+    shifted = phases[:, None] + pattern[None, :]
+    expected = (np.floor((end - shifted) / period) - np.floor((start - shifted) / period)).sum(axis=1)
+
+    hits = np.minimum(hits, expected)
+    scores = 2 * hits / (len(timestamps) + expected)
+    best = int(np.argmax(scores))
+    return Match(float(scores[best]), float(phases[best]), int(hits[best]))
+
+
+class Scorer:
+    """A Scorer matches the most recent beats of a timeline against a target as they are produced"""
+
+    def __init__(self, target: Target, tolerance: float = 0.05, window: Optional[float] = None, capacity: int = 1024):
+        self.target = target
+        self.tolerance = tolerance
+        """Maximum distance in seconds between a beat and a target beat for them to match"""
+
+        self.window = 2 * target.period if window is None else window
+        """Length in seconds of the window of beats that is matched"""
+
+        self.since = 0.0
+        """Time in seconds when play started or last jumped, before which no beats can have been played"""
+
+        self.beats = BeatLog(capacity)
+        self.match = Match(0.0, 0.0, 0)
+
+    def reset(self, timestamp: float = 0.0) -> None:
+        """Forgets every beat, for play starting again at timestamp"""
+        self.since = timestamp
+        self.beats.clear()
+        self.match = Match(0.0, 0.0, 0)
+
+    def update(self, beats: Sequence[Beat], timestamp: float) -> Match:
+        """Adds the beats produced by a timeline update and matches the window ending at timestamp"""
+        self.beats.extend(beats)
+        # the window never reaches back before play started, where target beats could not have been played
+        start = max(self.since, timestamp - self.window)
+        timestamps, _ = self.beats.between(start, timestamp)
+        self.match = match(timestamps, start, timestamp, self.target, self.tolerance)
+        return self.match
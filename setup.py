@@ -14,10 +14,12 @@ setup(
             'include_patterns': [
                 'data/*.tmx',
                 'data/*.tsx',
+                'data/*.tiles.json',
                 'data/black.png',
                 'data/play.png',
                 'data/stop.png',
                 'models/**/*.dae',
+                'cache/models/*.bam',
                 'thumbs/*.png',
                 'config/*.ini',
                 'config/*.prc',
@@ -0,0 +1,585 @@
+from __future__ import annotations
+
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field
+from functools import partial
+from bisect import bisect_left, bisect_right
+import math
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Mapping, Optional, Set, Tuple
+
+import numpy as np
+
+from rhythm import Timeline, Beat
+from utils.grid import from_hex
+
+if TYPE_CHECKING:
+    from tiles import Track, Train
+
+
+@dataclass(frozen=True)
+class Loop:
+    """A Loop is a closed cycle of slots in a track map, along which the beats of a train repeat"""
+
+    slots: Tuple[int, ...]
+    """Slots of the loop in order of travel"""
+
+    starts: Tuple[float, ...]
+    """Cumulative cost at which each slot is entered, with the first slot entered at 0"""
+
+    period: float
+    """Cost of travelling once around the loop"""
+
+    beats: Tuple[float, ...]
+    """Sorted cumulative costs of the beats within one period"""
+
+    def beats_between(self, start: float, end: float) -> List[float]:
+        """Returns the cumulative costs of all beats in (start, end], which may span any number of periods"""
+        costs = []
+        for n in range(math.floor(start / self.period), math.floor(end / self.period) + 1):
+            base = n * self.period
+            lo = bisect_right(self.beats, start - base)
+            hi = bisect_right(self.beats, end - base)
+            costs += [base + beat for beat in self.beats[lo:hi]]
+        return costs
+
+    def locate(self, cost: float) -> Tuple[int, float]:
+        """Returns the index of the slot containing the cumulative cost and the start of that slot
+
+        A cost exactly on the boundary between two slots is in the first of them.
+        """
+        n = math.floor(cost / self.period)
+        index = bisect_left(self.starts, cost - n * self.period) - 1
+        if index < 0:
+            n, index = n - 1, len(self.starts) - 1
+        return index, n * self.period + self.starts[index]
+
+
+class TrackMap(MutableMapping):
+    """A TrackMap is a mapping of cells to track tiles that keeps a compiled edge table of the connections between them
+
+    Every tile in the map is given an index, and each direction of travel
+    through it a slot: 2 * index when travelling from src to dst and
+    2 * index + 1 when travelling from dst to src. The tables below are
+    indexed by slot and are updated incrementally as tiles are set or
+    deleted, so moving a train between tiles is a list lookup.
+    """
+
+    def __init__(self, tiles: Mapping[Tuple[int, int], Track] = {}):
+        self._tiles: Dict[Tuple[int, int], Track] = {}
+        self._index: Dict[Tuple[int, int], int] = {}
+        self._free: List[int] = []
+        self._exits: List[Optional[Callable[[int, int], Tuple[int, int]]]] = []
+        self._incoming: Dict[Tuple[int, int], Set[int]] = {}
+        self._loops: Dict[int, Optional[Tuple[Loop, int]]] = {}
+
+        self.version = 0
+        """Incremented every time a tile is set or deleted"""
+
+        self.cells: List[Optional[Tuple[int, int]]] = []
+        """Cell of each index"""
+
+        self.tiles: List[Optional[Track]] = []
+        """Tile of each index"""
+
+        self.next: List[int] = []
+        """Slot the train moves to after leaving each slot, or -1 if the track ends"""
+
+        self.length: List[float] = []
+        """Cost of travelling through each slot, subtracted from the offset of a train leaving it"""
+
+        self.beats: List[Tuple[float, ...]] = []
+        """Cumulative costs of the beats produced by each slot, in order of travel"""
+
+        self.update(tiles)
+
+    def __getitem__(self, cell: Tuple[int, int]) -> Track:
+        return self._tiles[cell]
+
+    def get(self, cell: Tuple[int, int], default: Optional[Track] = None) -> Optional[Track]:
+        return self._tiles.get(cell, default)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(self._tiles)
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+    def __setitem__(self, cell: Tuple[int, int], tile: Track) -> None:
+        index = self._index.get(cell)
+        if index is None:
+            if self._free:
+                index = self._free.pop()
+            else:
+                index = len(self.cells)
+                self.cells.append(None)
+                self.tiles.append(None)
+                self._exits += [None, None]
+                self.next += [-1, -1]
+                self.length += [0.0, 0.0]
+                self.beats += [(), ()]
+            self._index[cell] = index
+        else:
+            self._unlink(index)
+
+        self._tiles[cell] = tile
+        self.cells[index] = cell
+        self.tiles[index] = tile
+        length = tile.path[-1][0]
+        for slot, exit, beats in (
+            (2 * index, tile.dst, sorted(tile.beats)),
+            (2 * index + 1, tile.src, sorted(length - beat for beat in tile.beats)),
+        ):
+            self._exits[slot] = exit
+            self._incoming.setdefault(exit(*cell), set()).add(slot)
+            self.length[slot] = length
+            self.beats[slot] = tuple(beats)
+            self._link(slot)
+
+        self._relink(cell)
+        self._loops.clear()
+        self.version += 1
+
+    def __delitem__(self, cell: Tuple[int, int]) -> None:
+        del self._tiles[cell]
+        index = self._index.pop(cell)
+        self._unlink(index)
+        self.cells[index] = None
+        self.tiles[index] = None
+        for slot in (2 * index, 2 * index + 1):
+            self._exits[slot] = None
+            self.next[slot] = -1
+            self.length[slot] = 0.0
+            self.beats[slot] = ()
+        self._free.append(index)
+
+        self._relink(cell)
+        self._loops.clear()
+        self.version += 1
+
+    def slot(self, x: int, y: int, direction: int) -> int:
+        """Returns the slot for travelling through the given cell in the given direction, or -1 if there is no track"""
+        index = self._index.get((x, y))
+        if index is None:
+            return -1
+        return 2 * index if direction > 0 else 2 * index + 1
+
+    def loop(self, slot: int) -> Optional[Tuple[Loop, int]]:
+        """Returns the loop through the given slot and the position of the slot in it, or None if the slot is not on a loop
+
+        Loops are cached until the next time a tile is set or deleted.
+        """
+        if slot in self._loops:
+            return self._loops[slot]
+
+        path = []
+        seen = {}
+        current = slot
+        while current >= 0 and current not in seen and current not in self._loops:
+            seen[current] = len(path)
+            path.append(current)
+            current = self.next[current]
+
+        # everything walked before the cycle (if any) leads into it or off the end of the track
+        cycle_start = seen.get(current, len(path))
+        for prefix in path[:cycle_start]:
+            self._loops[prefix] = None
+        if cycle_start < len(path):
+            slots = tuple(path[cycle_start:])
+            starts = []
+            beats = []
+            period = 0.0
+            for s in slots:
+                starts.append(period)
+                beats += [period + beat for beat in self.beats[s]]
+                period += self.length[s]
+            loop = Loop(slots, tuple(starts), period, tuple(sorted(beats)))
+            for i, s in enumerate(slots):
+                self._loops[s] = loop, i
+        return self._loops[slot]
+
+    def _link(self, slot: int) -> None:
+        exit = self._exits[slot]
+        index = self._index.get(exit(*self.cells[slot >> 1]))
+        self.next[slot] = -1
+        if index is not None:
+            tile = self.tiles[index]
+            if tile.src == exit.reverse:
+                self.next[slot] = 2 * index
+            elif tile.dst == exit.reverse:
+                self.next[slot] = 2 * index + 1
+
+    def _unlink(self, index: int) -> None:
+        cell = self.cells[index]
+        for slot in (2 * index, 2 * index + 1):
+            self._incoming[self._exits[slot](*cell)].discard(slot)
+
+    def _relink(self, cell: Tuple[int, int]) -> None:
+        for slot in self._incoming.get(cell, ()):
+            self._link(slot)
+
+
+@dataclass
+class TrainState:
+    """A TrainState is the simulated position of a train, independent of any scene graph"""
+
+    tile: Train
+    """Tile the train starts on"""
+
+    tile_x: int
+    tile_y: int
+
+    offset: float = 0.5
+    """Cost of the train within its current tile at timestamp 0"""
+
+    direction: int = 1
+    """1 if the train travels from src to dst of its current tile, -1 otherwise"""
+
+    on_change: Optional[Callable[[int, int, int, float, int], None]] = field(default=None, repr=False, compare=False)
+    """Called with the cell, direction, offset and slot of the train whenever it moves or is reset, with a slot of -2 if it has to be looked up"""
+
+    x: int = field(init=False)
+    y: int = field(init=False)
+
+    slot: int = field(init=False, default=-1)
+    """Slot of the current tile and direction in the track map"""
+
+    _version: int = field(init=False, default=-1, repr=False)
+
+    def __post_init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.x = self.tile_x
+        self.y = self.tile_y
+        self.offset = 0.5
+        self.direction = 1
+        self._version = -1
+        self._store()
+
+    def update(self, old: float, new: float, track: TrackMap) -> List[Beat]:
+        """Moves the train from time old to time new and returns the beats it produced"""
+        if new * self.tile.speed + self.offset < 0:
+            self.reset()
+        self._resolve(track)
+        old_pos = old * self.tile.speed
+        current_pos = new * self.tile.speed
+        slot, offset = self.slot, self.offset
+        new_beats = []
+
+        # walk tile by tile until the train reaches a loop, the end of the track or the end of the update
+        while slot >= 0 and track.loop(slot) is None:
+            beats = track.beats[slot]
+            for i in range(bisect_right(beats, old_pos + offset), bisect_right(beats, current_pos + offset)):
+                new_beats.append(Beat((beats[i] - offset) / self.tile.speed, self.tile.tile_id))
+            length = track.length[slot]
+            next_slot = track.next[slot]
+            if current_pos + offset <= length or next_slot < 0:
+                break
+            slot, offset = next_slot, offset - length
+
+        on_loop = track.loop(slot) if slot >= 0 else None
+        if on_loop is not None:
+            # the rest of the journey is periodic, so work it out in cumulative cost along the loop
+            loop, index = on_loop
+            start = loop.starts[index] + offset
+            new_beats += [
+                Beat((cost - start) / self.tile.speed, self.tile.tile_id)
+                for cost in loop.beats_between(start + old_pos, start + current_pos)
+            ]
+            index, entered = loop.locate(start + current_pos)
+            slot, offset = loop.slots[index], start - entered
+
+        self.offset = offset
+        if slot != self.slot:
+            self.slot = slot
+            self.x, self.y = track.cells[slot >> 1]
+            self.direction = -1 if slot & 1 else 1
+        self._store()
+        return new_beats
+
+    def next_event(self, timestamp: float, track: TrackMap) -> float:
+        """Returns the time of the next beat or change of tile after the given time, or infinity if the train has stopped"""
+        self._resolve(track)
+        if self.slot < 0 or self.tile.speed <= 0:
+            return math.inf
+        beats = track.beats[self.slot]
+        i = bisect_right(beats, timestamp * self.tile.speed + self.offset)
+        cost = beats[i] if i < len(beats) else math.inf
+        if track.next[self.slot] >= 0:
+            cost = min(cost, track.length[self.slot])
+        return (cost - self.offset) / self.tile.speed
+
+    def save_state(self) -> Tuple[int, int, int, float]:
+        return self.x, self.y, self.direction, self.offset
+
+    def load_state(self, state: Tuple[int, int, int, float]) -> None:
+        self.x, self.y, self.direction, self.offset = state
+        self._version = -1
+        self._store()
+
+    def loop(self, track: TrackMap) -> Optional[Loop]:
+        """Returns the loop the train is travelling around, or None if it has not reached one"""
+        on_loop = track.loop(self.slot) if self.slot >= 0 else None
+        return on_loop[0] if on_loop is not None else None
+
+    def _resolve(self, track: TrackMap) -> None:
+        if self._version != track.version:
+            self.slot = track.slot(self.x, self.y, self.direction)
+            self._version = track.version
+
+    def _store(self) -> None:
+        if self.on_change is not None:
+            self.on_change(self.x, self.y, self.direction, self.offset, self.slot if self._version >= 0 else -2)
+
+    def pose(self, timestamp: float, track: Mapping[Tuple[int, int], Track]) -> Optional[Tuple[float, float, float]]:
+        """Returns the x and y position and the heading of the train at the given time, or None if it is off the track"""
+        current_tile = track.get((self.x, self.y))
+        if current_tile is None:
+            return None
+        current_pos = timestamp * self.tile.speed + self.offset
+
+        if self.direction > 0:
+            path = iter(current_tile.path)
+            dir_offset = 0
+        else:
+            path = iter(reversed(current_tile.path))
+            dir_offset = current_tile.path[-1][0]
+        prev_cost, (prev_x, prev_y) = next(path)
+        prev_cost = dir_offset + self.direction * prev_cost
+        for cost, (node_x, node_y) in path:
+            cost = dir_offset + self.direction * cost
+            angle = math.degrees(math.atan2(prev_y - node_y, prev_x - node_x))
+            if current_pos < cost:
+                frac = (current_pos - prev_cost) / (cost - prev_cost)
+                local_x = prev_x + (node_x - prev_x) * frac
+                local_y = prev_y + (node_y - prev_y) * frac
+                break
+            prev_x, prev_y, prev_cost = node_x, node_y, cost
+        else:
+            local_x, local_y = prev_x, prev_y
+        hex_x, hex_y = from_hex(self.x, self.y)
+        return hex_x + local_x, hex_y + local_y, angle
+
+
+class Occupancy:
+    """An Occupancy maps cells to the trains on them, updated as each train moves so no lookup has to scan every train"""
+
+    def __init__(self):
+        self.trains: Dict[Tuple[int, int], Set[int]] = {}
+        """Trains on each occupied cell"""
+
+        self.cells: Dict[int, Tuple[int, int]] = {}
+        """Cell each train is on"""
+
+        self.collided: Set[int] = set()
+        """Trains that have shared a cell with another train since collisions were last taken"""
+
+    def move(self, train: int, cell: Tuple[int, int]) -> None:
+        old = self.cells.get(train)
+        if old == cell:
+            return
+        if old is not None:
+            others = self.trains[old]
+            others.discard(train)
+            if not others:
+                del self.trains[old]
+        self.cells[train] = cell
+        others = self.trains.setdefault(cell, set())
+        if others:
+            self.collided |= others
+            self.collided.add(train)
+        others.add(train)
+
+    def is_free(self, cell: Tuple[int, int], train: int = -1) -> bool:
+        """Returns whether no train other than the given one is on a cell"""
+        trains = self.trains.get(cell, ())
+        return len(trains) <= (train in trains)
+
+    def take_collisions(self) -> Set[int]:
+        """Returns the trains that have shared a cell with another train since this was last called"""
+        collided, self.collided = self.collided, set()
+        return collided
+
+
+class TrainBatch:
+    """A TrainBatch keeps the positions of many trains in arrays, so they can all be posed at once
+
+    Each train passes store() as its on_change callback, so it writes its cell,
+    direction and offset into the arrays whenever the timeline moves it. Between those events, a train moves at a constant speed
+    along the path of its slot. The paths are compiled into padded tables of segments,
+    indexed by slot, every time the track map changes.
+    """
+
+    def __init__(self, track: TrackMap):
+        self.track = track
+        self.size = 0
+
+        self.cells = np.zeros((0, 2), np.int64)
+        """Cell each train is on"""
+
+        self.directions = np.zeros(0, np.int8)
+        """1 if each train travels from src to dst of its current tile, -1 otherwise"""
+
+        self.offsets = np.zeros(0, np.float64)
+        """Cost of each train within its current tile at timestamp 0"""
+
+        self.speeds = np.zeros(0, np.float64)
+        """Cost travelled by each train in 1 second"""
+
+        self.slots = np.zeros(0, np.int64)
+        """Slot of each train in the track map, -1 if it is off the track or -2 if it has to be looked up"""
+
+        self.poses = np.zeros((0, 3), np.float64)
+        """Position and heading of each train when last posed"""
+
+        self.occupancy = Occupancy()
+        """Trains on each cell, as of the last time each train was updated"""
+
+        self._version = -1
+        self._start = self._end = np.zeros((0, 1), np.float64)
+        self._points = np.zeros((0, 2, 2), np.float64)
+        self._headings = np.zeros((0, 1), np.float64)
+        self._segments = np.zeros(0, np.int64)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, speed: float) -> int:
+        """Adds a train moving at speed, returning the index it stores its position at"""
+        if self.size == len(self.offsets):
+            # grow by doubling so adding thousands of trains only copies the arrays a few times
+            capacity = max(16, 2 * self.size)
+            for name in ('cells', 'directions', 'offsets', 'speeds', 'slots', 'poses'):
+                old = getattr(self, name)
+                new = np.zeros((capacity, *old.shape[1:]), old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+        index = self.size
+        self.size += 1
+        self.speeds[index] = speed
+        self.poses[index] = np.nan
+        return index
+
+    def store(self, index: int, x: int, y: int, direction: int, offset: float, slot: int) -> None:
+        """Records where a train is, as given to the on_change callback of its TrainState"""
+        self.cells[index] = x, y
+        self.directions[index] = direction
+        self.offsets[index] = offset
+        self.slots[index] = slot
+        self.occupancy.move(index, (x, y))
+
+    def is_clear(self, index: int, distance: int = 1) -> bool:
+        """Returns whether the next distance tiles ahead of a train are free of other trains, which they are not if the track ends first"""
+        if self._version != self.track.version or self.slots[index] == -2:
+            self._resolve()
+        slot = int(self.slots[index])
+        for _ in range(distance):
+            slot = self.track.next[slot] if slot >= 0 else -1
+            if slot < 0 or not self.occupancy.is_free(self.track.cells[slot >> 1], index):
+                return False
+        return True
+
+    def move(self, timestamp: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Poses every train on the track at the given time, returning the indices and poses of those that moved"""
+        self._resolve()
+        index = np.flatnonzero(self.slots[:self.size] >= 0)
+        slot = self.slots[index]
+        position = timestamp * self.speeds[index] + self.offsets[index]
+
+        # the segment a train is on is the first that ends after it, or the last if it has run off the end
+        segment = np.minimum((self._end[slot] <= position[:, None]).sum(axis=1), self._segments[slot] - 1)
+        start, end = self._start[slot, segment], self._end[slot, segment]
+        a, b = self._points[slot, segment], self._points[slot, segment + 1]
+        fraction = np.minimum((position - start) / (end - start), 1)[:, None]
+        local = a + (b - a) * fraction
+
+        x, y = from_hex(*self.cells[index].T)
+        poses = np.column_stack((x + local[:, 0], y + local[:, 1], self._headings[slot, segment]))
+        moved = np.any(poses != self.poses[index], axis=1)
+        index, poses = index[moved], poses[moved]
+        self.poses[index] = poses
+        return index, poses
+
+    def _resolve(self) -> None:
+        if self._version != self.track.version:
+            self._compile()
+            self.slots[:self.size] = -2
+        for i in np.flatnonzero(self.slots[:self.size] == -2).tolist():
+            (x, y), direction = self.cells[i].tolist(), int(self.directions[i])
+            self.slots[i] = self.track.slot(x, y, direction)
+
+    def _compile(self) -> None:
+        track = self.track
+        paths = [tile.path if tile is not None else () for tile in track.tiles]
+        segments = max([len(path) - 1 for path in paths] + [1])
+        slots = len(track.next)
+        self._start = np.full((slots, segments), np.inf)
+        self._end = np.full((slots, segments), np.inf)
+        self._points = np.zeros((slots, segments + 1, 2))
+        self._headings = np.zeros((slots, segments))
+        self._segments = np.ones(slots, np.int64)
+        # tiles with the same shape share their path, so each is only converted once
+        compiled = {}
+        for index, path in enumerate(paths):
+            if len(path) < 2:
+                continue
+            if path not in compiled:
+                costs = np.array([cost for cost, _ in path], np.float64)
+                points = np.array([point for _, point in path], np.float64)
+                # travelling from dst to src walks the path backwards, with costs measured from dst
+                compiled[path] = []
+                for costs, points in ((costs, points), (costs[-1] - costs[::-1], points[::-1])):
+                    delta = points[:-1] - points[1:]
+                    compiled[path].append((costs[:-1], costs[1:], points, np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))))
+            count = len(path) - 1
+            for slot, (start, end, points, headings) in zip((2 * index, 2 * index + 1), compiled[path]):
+                self._start[slot, :count] = start
+                self._end[slot, :count] = end
+                self._points[slot, :count + 1] = points
+                self._headings[slot, :count] = headings
+                self._segments[slot] = count
+        self._version = track.version
+
+
+class Simulation:
+    """A Simulation runs trains over a track map on a timeline, without needing Panda3D
+
+    Each train is scheduled on the timeline separately and is only updated
+    when it reaches a beat or a new tile. If the track is edited while the
+    timeline is running, timeline.reschedule() must be called.
+    """
+
+    def __init__(self, track: Optional[Mapping[Tuple[int, int], Track]] = None, timeline: Optional[Timeline] = None):
+        self.track = track if isinstance(track, TrackMap) else TrackMap(track or {})
+        self.timeline = Timeline() if timeline is None else timeline
+        self.trains: List[TrainState] = []
+        self.batch = TrainBatch(self.track)
+
+    def add_train(self, tile: Train, x: int, y: int) -> TrainState:
+        train = TrainState(tile, x, y, on_change=partial(self.batch.store, self.batch.add(tile.speed)))
+        self.trains.append(train)
+        self.timeline.subscribe(
+            partial(train.update, track=self.track),
+            train.save_state,
+            train.load_state,
+            partial(train.next_event, track=self.track),
+        )
+        return train
+
+    def run(self, duration: float, step: float = 1 / 60) -> List[Beat]:
+        """Advances the timeline by duration seconds in steps of at most step seconds"""
+        beats = []
+        steps = max(1, math.ceil(duration / step))
+        for _ in range(steps):
+            beats += self.timeline.update(duration / steps)
+        return beats
+
+
+def load_layout(layers: Dict[Tuple[int, int], Track], timeline: Optional[Timeline] = None) -> Simulation:
+    """Builds a simulation from a mapping of cells to track tiles, adding a train on every Train tile"""
+    from tiles import Train
+    simulation = Simulation(TrackMap(layers), timeline)
+    for (x, y), tile in layers.items():
+        if isinstance(tile, Train):
+            simulation.add_train(tile, x, y)
+    return simulation
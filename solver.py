@@ -0,0 +1,343 @@
+"""Searches for layouts of track whose loop reproduces the target rhythm of a level
+
+The train's loop must leave its tile through dst and come back through src,
+so the search places one piece of track per cell along a path between
+those two neighbours. Beats are placed on a grid of subdivisions positions
+per tile, and a partial path is abandoned as soon as no rotation of the
+target agrees with the beats it has fixed so far.
+"""
+
+import json, os, sys, time
+from multiprocessing import Pool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from level import Level, load_level
+from rhythm import Target, match
+from simulation import TrackMap
+from tiles import sides, tiles, Track
+
+
+data_dir = Path('data')
+
+# number of positions within a tile that beats can fall on
+subdivisions = 4
+
+# maximum number of dead end states remembered by each worker
+max_failed = 1 << 20
+
+
+@dataclass
+class Problem:
+    """A Problem is a level reduced to integers so that it can be searched quickly and sent to worker processes"""
+
+    cells: List[Tuple[int, int]]
+    """Cells track can be placed on"""
+
+    neighbours: List[Tuple[int, ...]]
+    """Index of the neighbour of each cell on each side, or -1"""
+
+    options: List[List[Tuple[int, int, int]]]
+    """For each side a piece can be entered through, the tile id, exit side and beat positions of every usable piece"""
+
+    start: int
+    """Cell the train enters after leaving its tile"""
+
+    start_side: int
+
+    goal: int
+    """Cell the train leaves to get back to its tile"""
+
+    goal_side: int
+
+    length: int
+    """Number of tiles in the loop, including the train's"""
+
+    target: int
+    """Bitmask of the positions of the target's beats in the loop"""
+
+    train: int
+    """Bitmask of the positions of the beats of the train's own tile"""
+
+    distance: List[int] = field(default_factory=list)
+    """Fewest steps from each cell to the goal"""
+
+    rotations: List[int] = field(default_factory=list)
+    """For each position, bitmask of the rotations of the target that have a beat there"""
+
+    def __post_init__(self):
+        size = self.length * subdivisions
+        self.rotations = [
+            sum(1 << r for r in range(size) if self.target >> ((position + r) % size) & 1)
+            for position in range(size)
+        ]
+        self.distance = [len(self.cells)] * len(self.cells)
+        self.distance[self.goal] = 0
+        frontier = [self.goal]
+        while frontier:
+            cell = frontier.pop(0)
+            for neighbour in self.neighbours[cell]:
+                if neighbour >= 0 and self.distance[neighbour] > self.distance[cell] + 1:
+                    self.distance[neighbour] = self.distance[cell] + 1
+                    frontier.append(neighbour)
+
+    def settle(self, alive: int, filled: int, positions: Iterable[int]) -> int:
+        """Returns the rotations in alive that agree with filled at all of the given positions"""
+        for position in positions:
+            if filled >> position & 1:
+                alive &= self.rotations[position]
+            else:
+                alive &= ~self.rotations[position]
+        return alive
+
+
+# state of a partial search: index in the loop, cell, side entered through,
+# visited cells, filled beat positions, remaining rotations and placed pieces
+State = Tuple[int, int, int, int, int, int, Tuple[Tuple[int, int], ...]]
+
+
+def palette_tiles(tile_list: Mapping[int, Track], palette: Iterable[int]) -> List[Track]:
+    """Returns the pieces in the palette along with all of their rotations"""
+    result = {}
+    for tile_id in palette:
+        while tile_id not in result:
+            result[tile_id] = tile_list[tile_id]
+            tile_id = tile_list[tile_id].rotate_cw
+    return list(result.values())
+
+
+def positions(beats: Iterable[float], scale: float) -> int:
+    """Returns a bitmask of the grid positions of beats, or raises ValueError if a beat is not on the grid"""
+    mask = 0
+    for beat in beats:
+        position = round(beat * scale)
+        if abs(position - beat * scale) > 1e-6:
+            raise ValueError(f'beat at {beat} is not on a grid of {scale} positions')
+        mask |= 1 << position
+    return mask
+
+
+def build_problem(level: Level, pieces: Sequence[Track], target: Target, tolerance: float) -> Problem:
+    if not level.trains:
+        raise ValueError('level has no train')
+    train_x, train_y, _, train = level.trains[0]
+
+    length = target.period * train.speed
+    if abs(length - round(length)) > tolerance * train.speed:
+        raise ValueError(f'a loop of {length} tiles cannot be built')
+    length = round(length)
+    target_mask = 0
+    for beat in target.beats:
+        position = beat * train.speed * subdivisions
+        if abs(position - round(position)) > tolerance * train.speed * subdivisions:
+            raise ValueError(f'target beat at {beat} cannot be produced by any track')
+        target_mask |= 1 << (round(position) % (length * subdivisions))
+
+    cells = [
+        cell for cell, clear in level.clear.items()
+        if clear and cell not in level.track
+    ]
+    index = {cell: i for i, cell in enumerate(cells)}
+    neighbours = [
+        tuple(index.get(side(*cell), -1) for side in sides)
+        for cell in cells
+    ]
+
+    options = [[] for _ in sides]
+    for tile in pieces:
+        if tile.path[-1][0] != 1:
+            raise ValueError(f'tile {tile.tile_id} is not one tile long')
+        src, dst = sides.index(tile.src), sides.index(tile.dst)
+        for entry, exit, beats in (
+            (src, dst, tile.beats),
+            (dst, src, [1 - beat for beat in tile.beats]),
+        ):
+            option = tile.tile_id, exit, positions(beats, subdivisions)
+            # pieces that leave the same way with the same beats are equivalent
+            if all(other[1:] != option[1:] for other in options[entry]):
+                options[entry].append(option)
+
+    start = train.dst(train_x, train_y)
+    goal = train.src(train_x, train_y)
+    if start not in index or goal not in index:
+        raise ValueError('the train is blocked in')
+    return Problem(
+        cells=cells,
+        neighbours=neighbours,
+        options=options,
+        start=index[start],
+        start_side=(sides.index(train.dst) + 3) % 6,
+        goal=index[goal],
+        goal_side=(sides.index(train.src) + 3) % 6,
+        length=length,
+        target=target_mask,
+        train=positions(train.beats, subdivisions),
+    )
+
+
+def initial_state(problem: Problem) -> State:
+    size = problem.length * subdivisions
+    filled = problem.train
+    alive = problem.settle((1 << size) - 1, filled, range(1, subdivisions))
+    return 1, problem.start, problem.start_side, 1 << problem.start, filled, alive, ()
+
+
+def expand(problem: Problem, state: State) -> Iterable[State]:
+    """Yields the states reachable by placing a piece on the current cell of a state"""
+    k, cell, side, visited, filled, alive, placed = state
+    size = problem.length * subdivisions
+    last = k == problem.length - 1
+    if problem.distance[cell] > problem.length - 1 - k or (cell == problem.goal) != last:
+        return
+    for tile_id, exit, beats in problem.options[side]:
+        new_filled = filled | beats << (k * subdivisions)
+        if new_filled >> size & 1:
+            new_filled = (new_filled & ~(1 << size)) | 1
+        new_alive = problem.settle(alive, new_filled, range(k * subdivisions, (k + 1) * subdivisions))
+        new_placed = placed + ((cell, tile_id),)
+        if last:
+            if exit == problem.goal_side:
+                new_alive = problem.settle(new_alive, new_filled, (0,))
+                if new_alive:
+                    yield k + 1, -1, -1, visited, new_filled, new_alive, new_placed
+        elif new_alive:
+            neighbour = problem.neighbours[cell][exit]
+            if neighbour >= 0 and not visited >> neighbour & 1:
+                yield k + 1, neighbour, (exit + 3) % 6, visited | 1 << neighbour, new_filled, new_alive, new_placed
+
+
+def search(problem: Problem, state: State, failed: Set[Tuple[int, ...]]) -> Optional[State]:
+    """Depth first search from a state for a complete loop, remembering states that lead nowhere"""
+    k, cell, side, visited, filled, alive, _ = state
+    if cell < 0:
+        return state
+    # beats before the current tile are already accounted for by alive
+    key = cell, side, visited, filled >> (k * subdivisions) & 1, alive
+    if key in failed:
+        return None
+    for next_state in expand(problem, state):
+        solution = search(problem, next_state, failed)
+        if solution is not None:
+            return solution
+    if len(failed) < max_failed:
+        failed.add(key)
+    return None
+
+
+_problem: Optional[Problem] = None
+_failed: Set[Tuple[int, ...]] = set()
+
+
+def _init_worker(problem: Problem) -> None:
+    global _problem
+    _problem = problem
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 4 * problem.length + 100))
+
+
+def _search_worker(state: State) -> Optional[State]:
+    return search(_problem, state, _failed)
+
+
+def solve(problem: Problem, solutions: int = 1, jobs: Optional[int] = None, split: int = 3) -> List[State]:
+    """Finds up to the given number of solutions, searching the subtrees below depth split in parallel"""
+    frontier = [initial_state(problem)]
+    for _ in range(split):
+        next_frontier = [s for state in frontier for s in expand(problem, state)]
+        if not next_frontier:
+            break
+        frontier = next_frontier
+        if any(state[1] < 0 for state in frontier):
+            break
+    found = [state for state in frontier if state[1] < 0]
+    frontier = [state for state in frontier if state[1] >= 0]
+    if len(found) >= solutions or not frontier:
+        return found[:solutions]
+
+    # the pool is terminated rather than closed, so subtrees still being searched are abandoned once enough are found
+    pool = Pool(jobs, initializer=_init_worker, initargs=(problem,))
+    try:
+        for solution in pool.imap_unordered(_search_worker, frontier):
+            if solution is not None:
+                found.append(solution)
+                if len(found) >= solutions:
+                    break
+    finally:
+        pool.terminate()
+    return found[:solutions]
+
+
+def verify(level: Level, tile_list: Mapping[int, Track], placed: Sequence[Tuple[Tuple[int, int], int]], target: Target, tolerance: float) -> float:
+    """Simulates a solution and returns how well its loop matches the target"""
+    x, y, _, train = level.trains[0]
+    track = TrackMap(level.track)
+    for cell, tile_id in placed:
+        track[cell] = tile_list[tile_id]
+    on_loop = track.loop(track.slot(x, y, 1))
+    if on_loop is None:
+        return 0.0
+    loop, index = on_loop
+    end = 2 * loop.period
+    timestamps = np.array(loop.beats_between(0, end)) / train.speed
+    return match(timestamps, 0, end / train.speed, target, tolerance).score
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '-l', '--level',
+        default=data_dir / 'level_01.tmx',
+    )
+    parser.add_argument(
+        '-p', '--palette', type=int, nargs='+',
+        default=list(range(1, 9)),
+        help='ids of the track pieces that can be placed, as offered in the tile tray',
+    )
+    parser.add_argument(
+        '--period', type=float,
+        help='length in seconds of the target loop, instead of the one given by the level',
+    )
+    parser.add_argument(
+        '--beats', type=lambda beats: tuple(sorted(float(beat) for beat in beats.split(','))),
+        help='comma separated beat times in seconds of the target loop',
+    )
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('-n', '--solutions', type=int, default=1)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--split', type=int, default=3, help='depth below which subtrees are searched in parallel')
+    args = parser.parse_args()
+
+    tile_list = tiles(None)
+    level = load_level(args.level, tile_list)
+    target = level.target
+    if args.period is not None and args.beats is not None:
+        target = Target(args.period, args.beats)
+    if target is None:
+        parser.error('the level has no target, give one with --period and --beats')
+
+    start = time.perf_counter()
+    try:
+        problem = build_problem(level, palette_tiles(tile_list['tracks.png'], args.palette), target, args.tolerance)
+    except ValueError as e:
+        parser.exit(1, f'{args.level}: {e}\n')
+    found = solve(problem, args.solutions, args.jobs, args.split)
+
+    layouts = [
+        [(problem.cells[cell], tile_id) for cell, tile_id in placed]
+        for *_, placed in found
+    ]
+    json.dump({
+        'level': str(args.level),
+        'time': time.perf_counter() - start,
+        'solutions': [
+            {
+                'score': verify(level, tile_list['tracks.png'], layout, target, args.tolerance),
+                'track': [[x, y, tile_id] for (x, y), tile_id in layout],
+            }
+            for layout in layouts
+        ],
+    }, sys.stdout, indent=2)
+    print()
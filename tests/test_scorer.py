@@ -0,0 +1,29 @@
+from rhythm import Beat, Scorer, Target
+
+
+target = Target(period=4.0, beats=(0.0, 1.0, 2.0, 2.5))
+
+
+def perfect_beats(start: float, end: float) -> list:
+    """Returns the beats of a layout that plays the target exactly, in (start, end]"""
+    return [
+        Beat(loop * target.period + beat, 0)
+        for loop in range(int(end // target.period) + 1)
+        for beat in target.beats
+        if start < loop * target.period + beat <= end
+    ]
+
+
+def test_perfect_loop_scores_fully_from_its_first_period():
+    scorer = Scorer(target)
+    start = 0.0
+    for end in (4.0, 6.0, 8.0, 12.0):
+        assert scorer.update(perfect_beats(start, end), end).score == 1.0
+        start = end
+
+
+def test_perfect_loop_scores_fully_after_a_seek():
+    scorer = Scorer(target)
+    scorer.update(perfect_beats(0.0, 12.0), 12.0)
+    scorer.reset(5.0)
+    assert scorer.update(perfect_beats(5.0, 9.0), 9.0).score == 1.0
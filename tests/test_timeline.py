@@ -0,0 +1,57 @@
+import random
+
+from generate_level import loop_cells, loop_track
+from simulation import Simulation
+from tiles import left, right, tiles, Train
+
+
+def looping_train() -> Simulation:
+    """Returns a simulation of a single train going around a loop of eight pieces of track"""
+    tile_list = tiles(None)
+    track_tiles = tile_list['tracks.png']
+    train = next(tile for tile in tile_list['tileset.png'].values() if isinstance(tile, Train))
+    cells = loop_cells(2, 2, 8)
+    track = {cell: track_tiles[tile_id] for cell, tile_id in loop_track(cells, track_tiles, random.Random(0)).items()}
+    start = next(cell for cell in cells if {track[cell].src, track[cell].dst} == {left, right})
+    track[start] = train
+    simulation = Simulation(track)
+    simulation.add_train(train, *start)
+    return simulation
+
+
+def beats_until(timestamp: float) -> list:
+    """Returns the beats of an uninterrupted run up to the given time"""
+    timeline = looping_train().timeline
+    for second in range(1, int(timestamp)):
+        timeline.advance(second)
+    timeline.advance(timestamp)
+    return timeline.beats.timestamps.tolist()
+
+
+def test_seek_back_then_forward_simulates_the_gap_again():
+    simulation = looping_train()
+    timeline = simulation.timeline
+    simulation.run(30)
+    timeline.seek(10)
+    assert timeline.beats.timestamps.tolist() == beats_until(10)
+    timeline.seek(30.5)
+    assert timeline.beats.timestamps.tolist() == beats_until(30.5)
+
+
+def test_repeated_seeks_keep_beats_sorted():
+    simulation = looping_train()
+    timeline = simulation.timeline
+    simulation.run(30)
+    for timestamp in (10, 30.5, 20, 5, 40, 12.25):
+        timeline.seek(timestamp)
+        assert timeline.beats.timestamps.tolist() == beats_until(timestamp)
+        assert len(timeline.beats) == timeline.beats.total
+
+
+def test_beat_at_the_end_of_an_advance_is_included():
+    reference = beats_until(10)
+    timeline = looping_train().timeline
+    for quarter in range(1, 41):
+        old, new = timeline.timestamp, quarter / 4
+        # stepping from beat to beat makes the next event of the train fall exactly on the end of each step
+        assert [beat.timestamp for beat in timeline.advance(new)] == [t for t in reference if old < t <= new]
@@ -1,15 +1,33 @@
-from copy import deepcopy
-from dataclasses import dataclass, field, replace
-import itertools
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache, partial
+import hashlib
+import json
 import math
 from pathlib import Path
-from typing import Mapping, Optional, Tuple, List, Callable, Sequence, Iterable
+import pickle
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, Mapping, Optional, Sequence, Tuple, List, Callable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    # panda3d is only needed once models are loaded, so the tile types can be used headless
+    from direct.showbase.ShowBase import ShowBase
+    from panda3d.core import GeomNode, LColor, NodePath, Point3, Vec3
+
 
-from direct.showbase import ShowBase
-from panda3d.core import NodePath
+# tileset descriptions, one for each tileset image used by levels
+catalog_dir = Path('data')
 
-from rhythm import Timeline, Beat
-from utils.grid import from_hex
+# baked copies of models with their transforms applied, so later runs skip parsing COLLADA
+model_cache_dir = Path('cache') / 'models'
+
+# compiled tileset descriptions
+catalog_cache_dir = Path('cache') / 'catalogs'
+
+# version of the layout of compiled catalogs, so old ones are compiled again when it changes
+catalog_version = 1
 
 
 @dataclass(frozen=True)
@@ -19,8 +37,8 @@ class Tile:
     tile_id: int = field(compare=True)
     """Identifier for this specific tile type"""
 
-    node: NodePath = field(compare=False)
-    """Contains models for the tile"""
+    model: Optional[Callable[[], NodePath]] = field(compare=False)
+    """Loads the models for the tile, or None if models are not loaded"""
 
     height: float = field(compare=False)
     """Height of the surface of the tile for placing other models on top"""
@@ -28,6 +46,18 @@ class Tile:
     clear: bool = field(compare=False)
     """If clear is true, rails and other buildings can be placed on the tile"""
 
+    @cached_property
+    def node(self) -> Optional[NodePath]:
+        """Contains models for the tile, loaded the first time it is needed"""
+        return None if self.model is None else self.model()
+
+    @cached_property
+    def lods(self) -> Optional[Tuple[NodePath, NodePath, NodePath]]:
+        """The full model, a simplified model and a flat impostor, for drawing the tile from further and further away"""
+        if self.node is None:
+            return None
+        return self.node, simplified_model(self.node), impostor_model(self.node)
+
 
 @dataclass(frozen=True)
 class Track(Tile):
@@ -56,91 +86,16 @@ class Track(Tile):
 class Train(Track):
     """A Train object represents the starting position of a train"""
 
-    train: NodePath = field(compare=False)
-    """Contains model for the train"""
+    train_model: Optional[Callable[[], NodePath]] = field(compare=False)
+    """Loads the model for the train, or None if models are not loaded"""
 
     speed: float = field(compare=False)
     """Cost travelled by the train in 1 second"""
 
-
-@dataclass
-class TrainInstance:
-    tile: Train
-    node: NodePath
-    tile_x: int
-    tile_y: int
-
-    offset: float = 0.5
-    direction: int = 1
-    x: int = field(init=False)
-    y: int = field(init=False)
-
-    def __post_init__(self):
-        self.x = self.tile_x
-        self.y = self.tile_y
-
-    def update(self, old: float, new:float, track: Mapping[Tuple[int, int], Track]) -> List[Beat]:
-        def update_position(x: int, y: int, offset: float, direction: int, old_pos: float, current_pos: float, current_tile: Track, beats: Optional[List[Beat]] = None) -> Tuple[int, int, float, int, Track, List[Beat]]:
-            if beats is None:
-                beats = []
-            if current_tile is None:
-                return x, y, offset, direction, None, beats
-            if direction > 0:
-                beats += [Beat(beat - offset, self.tile.tile_id) for beat in current_tile.beats if beat > old_pos + offset and beat <= current_pos + offset]
-            else:
-                beats += [Beat(beat - offset, self.tile.tile_id) for beat in current_tile.beats if current_tile.path[-1][0] - beat > old_pos + offset and current_tile.path[-1][0] - beat <= current_pos + offset]
-            if current_pos + offset > current_tile.path[-1][0]:
-                if direction > 0:
-                    del_fun = current_tile.dst
-                else:
-                    del_fun = current_tile.src
-                next_tile = track.get(del_fun(x, y))
-                if next_tile is not None:
-                    if next_tile.src == del_fun.reverse:
-                        return update_position(*del_fun(x, y), offset - current_tile.path[-1][0], 1, old_pos, current_pos, next_tile, beats)
-                    elif next_tile.dst == del_fun.reverse:
-                        return update_position(*del_fun(x, y), offset - current_tile.path[-1][0], -1, old_pos, current_pos, next_tile, beats)
-            return x, y, offset, direction, current_tile, beats
-
-        if new + self.offset < 0:
-            self.offset = 0.5
-            self.x = self.tile_x
-            self.y = self.tile_y
-        old_pos = old * self.tile.speed
-        current_pos = new * self.tile.speed
-        current_tile = track.get((self.x, self.y))
-        self.x, self.y, self.offset, self.direction, current_tile, new_beats = update_position(
-            self.x, self.y, self.offset, self.direction,
-            old_pos, current_pos, current_tile,
-        )
-        current_pos = new * self.tile.speed + self.offset
-
-        oldpos = self.node.getPos()
-
-        if self.direction > 0:
-            path = iter(current_tile.path)
-            dir_offset = 0
-        else:
-            path = iter(reversed(current_tile.path))
-            dir_offset = current_tile.path[-1][0]
-        prev_cost, (prev_x, prev_y) = next(path)
-        prev_cost = dir_offset + self.direction * prev_cost
-        for cost, (node_x, node_y) in path:
-            cost = dir_offset + self.direction * cost
-            angle = math.degrees(math.atan2(prev_y - node_y, prev_x - node_x))
-            if current_pos < cost:
-                frac = (current_pos - prev_cost) / (cost - prev_cost)
-                local_x = prev_x + (node_x - prev_x) * frac
-                local_y = prev_y + (node_y - prev_y) * frac
-                break
-            prev_x, prev_y, prev_cost = node_x, node_y, cost
-        else:
-            local_x, local_y = prev_x, prev_y
-        hex_x, hex_y = from_hex(self.x, self.y)
-        self.node.setPos(hex_x + local_x, hex_y + local_y, oldpos.z)
-        self.node.setHpr(60, 90, angle)
-
-        return new_beats
+    @cached_property
+    def train(self) -> Optional[NodePath]:
+        """Contains model for the train, loaded the first time it is needed"""
+        return None if self.train_model is None else self.train_model()
 
 
 def left(x: int, y: int) -> Tuple[int, int]:
@@ -192,478 +147,352 @@ right.rotate_ccw = up_right
 up_right.rotate_ccw = up_left
 up_left.rotate_ccw = left
 
-#                 rotations(nrot=3, id_offset=8, tiles=(
-#                     Track(
-#                         tile_id=1,
-#                         node=load_model(track_dir / "straight_1-2-3-4.dae"),
-#                         height=0.0,
-#                         clear=False,
-#                         removable=True,
-#                         src=left,
-#                         dst=right,
-#                         path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-#                         beats=[0, 0.25, 0.5, 0.75],
-#                    ),
-def rotations(nrot: int, id_offset: int, tiles: Sequence[Track]) -> Iterable[Track]:
-    c, s = math.cos(math.radians(-60)), math.sin(math.radians(-60))
-    for tile in tiles:
-        tile = replace(tile, rotate_ccw=tile.tile_id + id_offset, rotate_cw=tile.tile_id + (nrot - 1) * id_offset)
-        yield tile
-        for i in range(1, nrot):
-            node = deepcopy(tile.node)
-            h, p, r = node.getHpr()
-            node.setHpr(h, p, r + 60)
-            tile = replace(
-                tile,
-                tile_id=tile.tile_id + id_offset,
-                rotate_cw=tile.tile_id,
-                rotate_ccw=(tile.tile_id + 2 * id_offset) if i + 1 < nrot else (tile.tile_id - (nrot - 2) * id_offset),
-                node=node,
-                src=tile.src.rotate_ccw,
-                dst=tile.dst.rotate_ccw,
-                path=[(t, (x * c + y * s, -x * s + y * c)) for t, (x, y) in tile.path],
-            )
-            yield tile
-
-
-def tiles(base: ShowBase) -> Mapping[int, Tile]:
-    """Initialises list of tiles and loads required models"""
-    # TODO: consider loading this from a configuration file
-
-    items_dir = Path('models') / 'items'
-    tiles_dir = Path('models') / 'tiles'
-    track_dir = Path('models') / 'track'
-    train_dir = Path('models') / 'train'
-
-    def load_model(path: str, pos: Optional[Tuple[int, int, int]] = None,
-        rot: Optional[int] = 0, parent: Optional[NodePath] = None) -> NodePath:
-
-        node = base.loader.load_model(path)
-        node.set_hpr(60, 90, rot)
-
-        if pos is not None:
-            node.set_pos(*pos)
-
-        if parent is not None:
-            node.reparentTo(parent)
-
-        return node
-
-    def wrap_model(*args, parent: Optional[NodePath] = None, **kwargs):
-        dummy = NodePath('dummy')
-        load_model(*args, parent=dummy, **kwargs)
-        if parent is not None:
-            dummy.reparentTo(parent)
-        return dummy
-
-    return {
-        "tileset.png": {
-            tile.tile_id: tile
-            for tile in (
-                Tile(
-                    tile_id=0,
-                    node=load_model(tiles_dir / "building_cabin.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=1,
-                    node=load_model(tiles_dir / "building_castle.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=2,
-                    node=load_model(tiles_dir / "building_dock.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=3,
-                    node=load_model(tiles_dir / "building_farm.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=4,
-                    node=load_model(tiles_dir / "building_house.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=5,
-                    node=load_model(tiles_dir / "building_market.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=6,
-                    node=load_model(tiles_dir / "building_mill.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=7,
-                    node=load_model(tiles_dir / "building_mine.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=8,
-                    node=load_model(tiles_dir / "building_sheep.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=9,
-                    node=load_model(tiles_dir / "building_smelter.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=10,
-                    node=load_model(tiles_dir / "building_tower.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=11,
-                    node=load_model(tiles_dir / "building_village.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=12,
-                    node=load_model(tiles_dir / "building_wall.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=13,
-                    node=load_model(tiles_dir / "building_water.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=14,
-                    node=load_model(tiles_dir / "dirt.dae"),
-                    height=0.1,
-                    clear=True,
-                ),
-                Tile(
-                    tile_id=15,
-                    node=load_model(tiles_dir / "dirt_lumber.dae"),
-                    height=0.1,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=16,
-                    node=load_model(tiles_dir / "grass.dae"),
-                    height=0.2,
-                    clear=True,
-                ),
-                Tile(
-                    tile_id=17,
-                    node=load_model(tiles_dir / "grass_forest.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=18,
-                    node=load_model(tiles_dir / "grass_hill.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=19,
-                    node=load_model(tiles_dir / "river_corner.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=20,
-                    node=load_model(tiles_dir / "river_cornerSharp.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=21,
-                    node=load_model(tiles_dir / "river_crossing.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=22,
-                    node=load_model(tiles_dir / "river_end.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=23,
-                    node=load_model(tiles_dir / "river_intersectionA.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=24,
-                    node=load_model(tiles_dir / "river_intersectionB.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=25,
-                    node=load_model(tiles_dir / "river_intersectionC.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=26,
-                    node=load_model(tiles_dir / "river_intersectionD.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=27,
-                    node=load_model(tiles_dir / "river_intersectionE.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=28,
-                    node=load_model(tiles_dir / "river_intersectionF.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=29,
-                    node=load_model(tiles_dir / "river_intersectionG.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=30,
-                    node=load_model(tiles_dir / "river_intersectionH.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=31,
-                    node=load_model(tiles_dir / "river_start.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=32,
-                    node=load_model(tiles_dir / "river_straight.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=33,
-                    node=load_model(tiles_dir / "sand.dae"),
-                    height=0.2,
-                    clear=True,
-                ),
-                Tile(
-                    tile_id=34,
-                    node=load_model(tiles_dir / "sand_rocks.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=35,
-                    node=load_model(tiles_dir / "stone.dae"),
-                    height=0.2,
-                    clear=True,
-                ),
-                Tile(
-                    tile_id=36,
-                    node=load_model(tiles_dir / "stone_hill.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=37,
-                    node=load_model(tiles_dir / "stone_mountain.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=38,
-                    node=load_model(tiles_dir / "stone_rocks.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=39,
-                    node=load_model(tiles_dir / "water.dae"),
-                    height=0.1,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=40,
-                    node=load_model(tiles_dir / "water_island.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Tile(
-                    tile_id=41,
-                    node=load_model(tiles_dir / "water_rocks.dae"),
-                    height=0.2,
-                    clear=False,
-                ),
-                Train(
-                    tile_id=42,
-                    rotate_cw=None,
-                    rotate_ccw=None,
-                    node=load_model(track_dir / "straight_1-2-3-4.dae"),
-                    train=load_model(train_dir / "train.dae"),
-                    height=0.0,
-                    clear=False,
-                    removable=False,
-                    src=left,
-                    dst=right,
-                    path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-                    speed=1.0,
-                    beats=[],
-                ),
+# sides of a cell in clockwise order, so the opposite of side i is (i + 3) % 6
+sides = [left, up_left, up_right, right, down_right, down_left]
+
+# types of tile a tileset description can contain, in the order of their kind in a compiled catalog
+tile_types = [Tile, Track, Train]
+
+
+def rotated_model(node: NodePath, turns: int) -> NodePath:
+    """Returns a node that shares the geometry of a model, turned by a number of sides"""
+    from panda3d.core import NodePath
+    rotated = NodePath(node.get_name())
+    rotated.set_transform(node.get_transform())
+    h, p, r = rotated.getHpr()
+    rotated.setHpr(h, p, r + 60 * turns)
+    for child in node.get_children():
+        child.instanceTo(rotated)
+    return rotated
+
+
+def polygon_node(name: str, polygons: Iterable[Tuple[Sequence[Point3], Vec3, LColor]]) -> GeomNode:
+    """Returns a node drawing flat, single coloured polygons, each given by its corners and the direction it faces"""
+    from panda3d.core import ColorAttrib, Geom, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat, GeomVertexWriter, RenderState
+
+    node = GeomNode(name)
+    for corners, normal, colour in polygons:
+        # corners must wind counterclockwise when seen from the side the polygon faces
+        if (corners[1] - corners[0]).cross(corners[2] - corners[0]).dot(normal) < 0:
+            corners = corners[::-1]
+        data = GeomVertexData(name, GeomVertexFormat.get_v3n3(), Geom.UH_static)
+        vertex, normals = GeomVertexWriter(data, 'vertex'), GeomVertexWriter(data, 'normal')
+        for corner in corners:
+            vertex.add_data3(corner)
+            normals.add_data3(normal)
+        triangles = GeomTriangles(Geom.UH_static)
+        for i in range(1, len(corners) - 1):
+            triangles.add_vertices(0, i, i + 1)
+        geom = Geom(data)
+        geom.add_primitive(triangles)
+        node.add_geom(geom, RenderState.make(ColorAttrib.make_flat(colour)))
+    return node
+
+
+def geom_colour(node: GeomNode, i: int) -> LColor:
+    """Returns the diffuse or flat colour of a geom"""
+    from panda3d.core import ColorAttrib, LColor, MaterialAttrib
+    state = node.get_geom_state(i)
+    material = state.get_attrib(MaterialAttrib)
+    if material is not None and material.get_material() is not None:
+        return material.get_material().get_diffuse()
+    colour = state.get_attrib(ColorAttrib)
+    if colour is not None and colour.get_color_type() == ColorAttrib.T_flat:
+        return colour.get_color()
+    return LColor(0.5, 0.5, 0.5, 1)
+
+
+def ground(node: NodePath) -> NodePath:
+    """Returns the part of a model covering the most of the cell, which is the hexagon the rest stands on
+
+    Models are y up, so the cell lies in x and z.
+    """
+    def footprint(part):
+        low, high = part.get_tight_bounds(node)
+        return (high.x - low.x) * (high.z - low.z), -high.y
+    return max(node.find_all_matches('**/+GeomNode'), key=footprint)
+
+
+def simplified_model(node: NodePath) -> NodePath:
+    """Returns a copy of a model with everything standing on its ground replaced by boxes of the same size and colour"""
+    from panda3d.core import NodePath, Point3, Vec3
+
+    simplified = NodePath(node.get_name())
+    simplified.set_transform(node.get_transform())
+    base = ground(node)
+    base.copy_to(simplified).set_transform(base.get_transform(node))
+
+    boxes = []
+    for part in node.find_all_matches('**/+GeomNode'):
+        if part == base:
+            continue
+        low, high = part.get_tight_bounds(node)
+        colour = geom_colour(part.node(), 0)
+        for axis in range(3):
+            for side, normal in ((low, -1), (high, 1)):
+                # the four corners of the face of the box on this side of this axis
+                a, b = (axis + 1) % 3, (axis + 2) % 3
+                corners = []
+                for ua, ub in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                    corner = Point3(side)
+                    corner[a] = (low, high)[ua][a]
+                    corner[b] = (low, high)[ub][b]
+                    corners.append(corner)
+                facing = Vec3(0, 0, 0)
+                facing[axis] = normal
+                boxes.append((corners, facing, colour))
+    simplified.attach_new_node(polygon_node('boxes', boxes))
+    return simplified
+
+
+def impostor_model(node: NodePath) -> NodePath:
+    """Returns a flat hexagon at the top of the ground of a model, in the colour of the ground's top"""
+    from panda3d.core import GeomVertexReader, NodePath, Point3, Vec3
+
+    base = ground(node)
+    low, high = base.get_tight_bounds(node)
+    # the top of the ground is the geom whose lowest vertex is highest
+    def lowest(i):
+        reader = GeomVertexReader(base.node().get_geom(i).get_vertex_data(), 'vertex')
+        transform = base.get_mat(node)
+        points = []
+        while not reader.is_at_end():
+            points.append(transform.xform_point(reader.get_data3()).y)
+        return min(points)
+    top = max(range(base.node().get_num_geoms()), key=lowest)
+
+    centre = (low + high) / 2
+    radius_x, radius_z = (high.x - low.x) / 2, (high.z - low.z) / 2
+    corners = [
+        Point3(centre.x + radius_x * dx, high.y, centre.z + radius_z * dz)
+        for dx, dz in ((0, 1), (1, 0.5), (1, -0.5), (0, -1), (-1, -0.5), (-1, 0.5))
+    ]
+    impostor = NodePath(node.get_name())
+    impostor.set_transform(node.get_transform())
+    impostor.attach_new_node(polygon_node('impostor', [(corners, Vec3(0, 1, 0), geom_colour(base.node(), top))]))
+    return impostor
+
+
+@lru_cache(maxsize=None)
+def rotated_path(path: Tuple[Tuple[float, Tuple[float, float]], ...], turns: int) -> Tuple[Tuple[float, Tuple[float, float]], ...]:
+    """Returns a path turned by a number of sides, shared by every tile with the same path and rotation"""
+    c, s = math.cos(math.radians(-60 * turns)), math.sin(math.radians(-60 * turns))
+    return tuple((t, (x * c + y * s, -x * s + y * c)) for t, (x, y) in path)
+
+
+def cached_model(base: ShowBase, path: Path, hpr: Tuple[float, float, float],
+    pos: Optional[Tuple[float, float, float]] = None) -> NodePath:
+    """Loads a model with a transform applied, from model_cache_dir if it has been baked before
+
+    The baked file is keyed by the contents of the source file, the
+    transform and the panda3d version, so any change to them bakes it again.
+    Failing to read or write the cache falls back to loading the source.
+    """
+    from panda3d.core import Filename, PandaSystem
+
+    key = hashlib.sha256(Path(path).read_bytes())
+    key.update(repr((hpr, pos, PandaSystem.get_version_string())).encode())
+    baked = model_cache_dir / f'{Path(path).stem}-{key.hexdigest()[:16]}.bam'
+
+    if baked.exists():
+        try:
+            return base.loader.load_model(Filename.from_os_specific(str(baked.resolve())))
+        except IOError:
+            pass
+
+    node = base.loader.load_model(path)
+    node.set_hpr(*hpr)
+    if pos is not None:
+        node.set_pos(*pos)
+
+    try:
+        model_cache_dir.mkdir(parents=True, exist_ok=True)
+        node.write_bam_file(Filename.from_os_specific(str(baked.resolve())))
+    except OSError:
+        pass
+    return node
+
+
+def compile_catalog(path: Path) -> Dict[str, np.ndarray]:
+    """Expands a tileset description, including every rotation of its track, into arrays indexed by tile id
+
+    A description names the tileset image it belongs to, optional defaults
+    shared by its tiles and the tiles themselves. A track with a number of
+    rotations also fills the ids rotation_offset, 2 * rotation_offset and so
+    on above its own with copies turned counterclockwise by one more side.
+    """
+    description = json.loads(Path(path).read_text())
+    offset = description.get('rotation_offset', 0)
+    entries = {}
+    for entry in description['tiles']:
+        entry = {**description.get('defaults', {}), **entry}
+        for turns in range(entry.get('rotations', 1)):
+            entries[entry['id'] + turns * offset] = entry, turns
+
+    size = max(entries, default=-1) + 1
+    models = sorted({entry[key] for entry, _ in entries.values() for key in ('model', 'train') if key in entry})
+    arrays = {
+        'kind': np.zeros(size, np.int8),
+        'height': np.zeros(size, np.float64),
+        'clear': np.zeros(size, bool),
+        'removable': np.zeros(size, bool),
+        'model': np.full(size, -1, np.int16),
+        'train': np.full(size, -1, np.int16),
+        'turns': np.zeros(size, np.int8),
+        'speed': np.zeros(size, np.float64),
+        'src': np.full(size, -1, np.int8),
+        'dst': np.full(size, -1, np.int8),
+        'rotate_cw': np.full(size, -1, np.int16),
+        'rotate_ccw': np.full(size, -1, np.int16),
+        'path': np.zeros((size, 2), np.int32),
+        'beats': np.zeros((size, 2), np.int32),
+    }
+    side_names = [side.__name__ for side in sides]
+    paths, beats = {}, []
+    for tile_id, (entry, turns) in entries.items():
+        arrays['kind'][tile_id] = [t.__name__.lower() for t in tile_types].index(entry.get('type', 'tile')) + 1
+        arrays['height'][tile_id] = entry['height']
+        arrays['clear'][tile_id] = entry['clear']
+        arrays['model'][tile_id] = models.index(entry['model'])
+        arrays['turns'][tile_id] = turns
+        if 'src' not in entry:
+            continue
+
+        arrays['removable'][tile_id] = entry['removable']
+        arrays['src'][tile_id] = (side_names.index(entry['src']) - turns) % len(sides)
+        arrays['dst'][tile_id] = (side_names.index(entry['dst']) - turns) % len(sides)
+        if 'rotations' in entry:
+            base, rotations = tile_id - turns * offset, entry['rotations']
+            arrays['rotate_cw'][tile_id] = base + (turns - 1) % rotations * offset
+            arrays['rotate_ccw'][tile_id] = base + (turns + 1) % rotations * offset
+        # tiles with the same shape and rotation share a single path
+        path = rotated_path(tuple((t, (x, y)) for t, x, y in entry['path']), turns)
+        start = paths.setdefault(path, sum(map(len, paths)))
+        arrays['path'][tile_id] = start, start + len(path)
+        arrays['beats'][tile_id] = len(beats), len(beats) + len(entry['beats'])
+        beats += entry['beats']
+        if 'train' in entry:
+            arrays['train'][tile_id] = models.index(entry['train'])
+            arrays['speed'][tile_id] = entry['speed']
+
+    arrays['image'] = np.array(description['image'])
+    arrays['models'] = np.array(models)
+    arrays['points'] = np.array([(t, x, y) for path in paths for t, (x, y) in path], np.float64).reshape(-1, 3)
+    arrays['beat_times'] = np.array(beats, np.float64)
+    return arrays
+
+
+def load_catalog(path: Path) -> Dict[str, np.ndarray]:
+    """Returns the compiled form of a tileset description, from catalog_cache_dir if it has been compiled before
+
+    The arrays are pickled rather than saved with np.savez, which takes
+    longer to read than compiling the description again.
+    """
+    key = hashlib.sha256(Path(path).read_bytes())
+    key.update(repr(catalog_version).encode())
+    compiled = catalog_cache_dir / f'{Path(path).name.split(".")[0]}-{key.hexdigest()[:16]}.pickle'
+
+    if compiled.exists():
+        try:
+            with open(compiled, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    arrays = compile_catalog(path)
+    try:
+        catalog_cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(compiled, 'wb') as f:
+            pickle.dump(arrays, f)
+    except OSError:
+        pass
+    return arrays
+
+
+class Catalog(Mapping[int, Tile]):
+    """A Catalog is a compiled tileset description, building each tile the first time it is looked up"""
+
+    def __init__(self, arrays: Mapping[str, np.ndarray], base: Optional[ShowBase]):
+        self.arrays = arrays
+        self.base = base
+        self.image = str(arrays['image'])
+        self.ids = np.flatnonzero(arrays['kind']).tolist()
+        self.tiles = {}
+        self.nodes = {}
+        self.paths = {}
+
+    def __getitem__(self, tile_id: int) -> Tile:
+        tile = self.tiles.get(tile_id)
+        if tile is None:
+            if not 0 <= tile_id < len(self.arrays['kind']) or not self.arrays['kind'][tile_id]:
+                raise KeyError(tile_id)
+            tile = self.tiles[tile_id] = self.build(tile_id)
+        return tile
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def model(self, model_id: int, turns: int = 0) -> NodePath:
+        """Loads a model once for all of the tiles that use it, turned by a number of sides"""
+        if model_id not in self.nodes:
+            self.nodes[model_id] = cached_model(self.base, Path(str(self.arrays['models'][model_id])), (60, 90, 0))
+        node = self.nodes[model_id]
+        return node if turns == 0 else rotated_model(node, turns)
+
+    def build(self, tile_id: int) -> Tile:
+        a = self.arrays
+        tile_type = tile_types[a['kind'][tile_id] - 1]
+        fields = dict(
+            tile_id=tile_id,
+            model=None if self.base is None else partial(self.model, int(a['model'][tile_id]), int(a['turns'][tile_id])),
+            height=float(a['height'][tile_id]),
+            clear=bool(a['clear'][tile_id]),
+        )
+        if issubclass(tile_type, Track):
+            start, end = a['path'][tile_id]
+            beats_start, beats_end = a['beats'][tile_id]
+            fields.update(
+                src=sides[a['src'][tile_id]],
+                dst=sides[a['dst'][tile_id]],
+                path=self.path(int(start), int(end)),
+                removable=bool(a['removable'][tile_id]),
+                beats=a['beat_times'][beats_start:beats_end].tolist(),
+                rotate_cw=int(a['rotate_cw'][tile_id]) if a['rotate_cw'][tile_id] >= 0 else None,
+                rotate_ccw=int(a['rotate_ccw'][tile_id]) if a['rotate_ccw'][tile_id] >= 0 else None,
             )
-        },
-        "tracks.png": {
-            tile.tile_id: tile
-            for tile in itertools.chain(
-                rotations(nrot=3, id_offset=8, tiles=(
-                    Track(
-                        tile_id=1,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "straight_1-2-3-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=right,
-                        path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-                        beats=[0, 0.25, 0.5, 0.75],
-                    ),
-                    Track(
-                        tile_id=3,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "straight_1-_-3-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=right,
-                        path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-                        beats=[0, 0.5, 0.75],
-                    ),
-                    Track(
-                        tile_id=4,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "straight_1-2-_-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=right,
-                        path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-                        beats=[0, 0.25, 0.75],
-                    ),
-                    Track(
-                        tile_id=5,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "straight_1-2-3-_.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=right,
-                        path=[(0, (0.5, 0)), (1, (-0.5, 0))],
-                        beats=[0, 0.25, 0.5],
-                    ),
-                )),
-                rotations(nrot=6, id_offset=8, tiles=(
-                    Track(
-                        tile_id=2,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "curved_1-2-3-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=up_right,
-                        path=[
-                            (0/4, (.5, 0)),
-                            (1/4, (.276, -.029)),
-                            (2/4, (.067, -.116)),
-                            (3/4, (-.112, -.253)),
-                            (4/4, (-.25, -.433)),
-                        ],
-                        beats=[0, 0.25, 0.5, 0.75],
-                    ),
-                    Track(
-                        tile_id=6,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "curved_1-_-3-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=up_right,
-                        path=[
-                            (0/4, (.5, 0)),
-                            (1/4, (.276, -.029)),
-                            (2/4, (.067, -.116)),
-                            (3/4, (-.112, -.253)),
-                            (4/4, (-.25, -.433)),
-                        ],
-                        beats=[0, 0.5, 0.75],
-                    ),
-                    Track(
-                        tile_id=7,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "curved_1-2-_-4.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=up_right,
-                        path=[
-                            (0/4, (.5, 0)),
-                            (1/4, (.276, -.029)),
-                            (2/4, (.067, -.116)),
-                            (3/4, (-.112, -.253)),
-                            (4/4, (-.25, -.433)),
-                        ],
-                        beats=[0, 0.25, 0.75],
-                    ),
-                    Track(
-                        tile_id=8,
-                        rotate_cw=None,
-                        rotate_ccw=None,
-                        node=load_model(track_dir / "curved_1-2-3-_.dae"),
-                        height=0.0,
-                        clear=False,
-                        removable=True,
-                        src=left,
-                        dst=up_right,
-                        path=[
-                            (0/4, (.5, 0)),
-                            (1/4, (.276, -.029)),
-                            (2/4, (.067, -.116)),
-                            (3/4, (-.112, -.253)),
-                            (4/4, (-.25, -.433)),
-                        ],
-                        beats=[0, 0.25, 0.5],
-                    ),
-                )),
+        if issubclass(tile_type, Train):
+            fields.update(
+                train_model=None if self.base is None else partial(self.model, int(a['train'][tile_id])),
+                speed=float(a['speed'][tile_id]),
             )
-        },
-    }
+        return tile_type(**fields)
+
+    def path(self, start: int, end: int) -> Tuple[Tuple[float, Tuple[float, float]], ...]:
+        """Returns the path stored between two rows of points, shared by every tile that uses it"""
+        if (start, end) not in self.paths:
+            self.paths[start, end] = tuple((t, (x, y)) for t, x, y in self.arrays['points'][start:end].tolist())
+        return self.paths[start, end]
+
+
+def tiles(base: Optional[ShowBase]) -> Mapping[str, Mapping[int, Tile]]:
+    """Loads every tileset description in catalog_dir, keyed by the tileset image it describes
+
+    Models are loaded the first time each tile needs one. If base is None no
+    models are loaded and every node is None, which is enough to simulate a
+    layout headless.
+    """
+    catalogs = [Catalog(load_catalog(path), base) for path in sorted(catalog_dir.glob('*.tiles.json'))]
+    return {catalog.image: catalog for catalog in catalogs}
+
+
+if __name__ == '__main__':
+    # bakes every model into the cache, e.g. before packaging with build_apps
+    from direct.showbase.ShowBase import ShowBase
+    for tile_list in tiles(ShowBase(windowType='none')).values():
+        for tile in tile_list.values():
+            tile.node
+            if isinstance(tile, Train):
+                tile.train
@@ -1,11 +1,13 @@
+from math import floor, hypot
+
 
 def from_hex(x, y):
-    x = x + .5 if y % 2 else x
-    y = y * 3**0.5 / 2
-    return -x, y
+    """Returns the centre of a cell, which also works on numpy arrays of cells"""
+    return -(x + .5 * (y % 2)), y * 3**0.5 / 2
 
 
 def to_hex(x, y):
-    y = round(y / (3**0.5 / 2))
-    x = round(x + .5 if y % 2 else x)
-    return -x, y
+    """Returns the cell whose centre is nearest to a point, which is the cell the point lies in"""
+    row = floor(y / (3**0.5 / 2))
+    cells = [(round(-x - .5 if r % 2 else -x), r) for r in (row, row + 1)]
+    return min(cells, key=lambda cell: hypot(*(a - b for a, b in zip(from_hex(*cell), (x, y)))))
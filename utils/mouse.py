@@ -1,4 +1,9 @@
-from panda3d.core import CollisionHandlerQueue, CollisionTraverser, CollisionNode, GeomNode, CollisionRay
+from math import ceil
+
+from panda3d.core import CollisionHandlerQueue, CollisionTraverser, CollisionNode, GeomNode, CollisionRay, Point3
+
+from utils.grid import to_hex
+
 
 class MouseHandler:
     def __init__(self, camera, level):
@@ -22,3 +27,43 @@ class MouseHandler:
             node = self.handler.getEntry(0).getIntoNodePath()
             if not node.isEmpty():
                 return node
+
+
+class HeightFieldPicker:
+    """A HeightFieldPicker finds the cell under the mouse by marching the mouse ray over the height of each cell"""
+    def __init__(self, camera, level, z, step=1/16):
+        self.camera = camera
+        self.level = level
+        self.z = z
+        self.step = step
+        self.top = max(z.values(), default=0)
+        self.bottom = min(z.values(), default=0)
+        self.last = None
+        self.cell = None
+
+    def pick_cell(self, mpos):
+        key = mpos.getX(), mpos.getY(), self.camera.getMat(self.level)
+        if key != self.last:
+            self.last = key
+            self.cell = self.march(mpos)
+        return self.cell
+
+    def march(self, mpos):
+        near, far = Point3(), Point3()
+        if not self.camera.getChild(0).node().getLens().extrude(mpos, near, far):
+            return None
+        origin = self.level.getRelativePoint(self.camera, near)
+        direction = self.level.getRelativeVector(self.camera, far - near)
+        if direction.z >= 0:
+            return None
+
+        # only the part of the ray between the highest and lowest surfaces can hit anything
+        start = (self.top - origin.z) / direction.z
+        end = (self.bottom - origin.z) / direction.z
+        steps = ceil((end - start) * direction.getXy().length() / self.step) + 1
+        for i in range(steps + 1):
+            point = origin + direction * (start + (end - start) * i / steps)
+            cell = to_hex(point.x, point.y)
+            height = self.z.get(cell)
+            if height is not None and point.z <= height + 1e-6:
+                return cell
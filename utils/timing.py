@@ -0,0 +1,79 @@
+from collections import deque
+from contextlib import contextmanager
+import json
+from time import perf_counter
+
+from panda3d.core import PStatCollector
+
+
+class FrameTimer:
+    """A FrameTimer records how long named scopes take in each of the most recent frames
+
+    Scopes timed with scope() are also PStats collectors under Game, so the
+    same timings show up in PStats when it is connected. Scopes timed with
+    begin() and end() can span several tasks, which PStats collectors
+    cannot, so they are only recorded here.
+    """
+    def __init__(self, capacity=600):
+        self.frames = deque(maxlen=capacity)
+        self.origin = perf_counter()
+        self.collectors = {}
+        self.events = []
+        self.open = {}
+        self.start = None
+
+    def new_frame(self):
+        """Ends the current frame, keeping its scopes, and starts the next"""
+        now = perf_counter()
+        for name in list(self.open):
+            self.end(name)
+        if self.start is not None:
+            self.frames.append((self.start, now, self.events))
+        self.start = now
+        self.events = []
+
+    def begin(self, name):
+        self.open[name] = perf_counter()
+
+    def end(self, name):
+        start = self.open.pop(name, None)
+        if start is not None:
+            self.events.append((name, start, perf_counter()))
+
+    @contextmanager
+    def scope(self, name):
+        collector = self.collectors.get(name)
+        if collector is None:
+            collector = self.collectors[name] = PStatCollector(f'Game:{name}')
+        collector.start()
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+            collector.stop()
+
+    def summary(self):
+        """Returns the mean and worst time in seconds spent in each scope per frame, with the whole frame as 'frame'"""
+        totals = {'frame': [end - start for start, end, _ in self.frames]}
+        for n, (_, _, events) in enumerate(self.frames):
+            for name, start, end in events:
+                times = totals.setdefault(name, [0.0] * len(self.frames))
+                times[n] += end - start
+        return {name: (sum(times) / len(times), max(times)) for name, times in totals.items() if times}
+
+    def chrome_trace(self):
+        """Returns the recorded frames as a Chrome trace, which chrome://tracing and Perfetto can open"""
+        to_us = lambda t: (t - self.origin) * 1e6
+        events = []
+        for start, end, scopes in self.frames:
+            events.append({'name': 'frame', 'ph': 'X', 'ts': to_us(start), 'dur': to_us(end) - to_us(start), 'pid': 0, 'tid': 0})
+            events += [
+                {'name': name, 'ph': 'X', 'ts': to_us(start), 'dur': to_us(end) - to_us(start), 'pid': 0, 'tid': 0}
+                for name, start, end in scopes
+            ]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.chrome_trace()))
@@ -0,0 +1,118 @@
+"""Checks every level in a directory, loading and simulating each one in a worker process"""
+
+import json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence
+
+from level import Level, load_level
+from simulation import Simulation, TrackMap
+from solver import build_problem, initial_state, palette_tiles, search, verify
+from tiles import tiles, Tile
+
+
+data_dir = Path('data')
+
+_tile_list: Optional[Mapping[str, Mapping[int, Tile]]] = None
+
+
+def _init_worker() -> None:
+    global _tile_list
+    _tile_list = tiles(None)
+
+
+def check_trains(level: Level) -> List[str]:
+    """Returns a problem for each train that is not on clear ground or cannot be connected to a loop"""
+    problems = []
+    for x, y, _, train in level.trains:
+        if not level.clear.get((x, y), False):
+            problems.append(f'train at {x}, {y} is not on clear ground')
+        for end in (train.src, train.dst):
+            cell = end(x, y)
+            neighbour = level.track.get(cell)
+            if neighbour is not None:
+                if end.reverse not in (neighbour.src, neighbour.dst):
+                    problems.append(f'train at {x}, {y} runs into track at {cell[0]}, {cell[1]} that does not connect to it')
+            elif not level.clear.get(cell, False):
+                problems.append(f'train at {x}, {y} is blocked at {cell[0]}, {cell[1]}')
+    return problems
+
+
+def validate(path: Path, palette: Sequence[int], duration: float, tolerance: float) -> Dict:
+    """Loads and checks a single level, returning a report"""
+    report = {'level': str(path), 'problems': [], 'warnings': []}
+
+    start = time.perf_counter()
+    try:
+        level = load_level(path, _tile_list)
+    except Exception as e:
+        report['problems'].append(f'failed to load: {e}')
+        return report
+    report['load_time'] = time.perf_counter() - start
+
+    if not level.trains:
+        report['problems'].append('level has no train')
+    report['problems'] += check_trains(level)
+
+    start = time.perf_counter()
+    simulation = Simulation(TrackMap(level.track))
+    for x, y, _, train in level.trains:
+        simulation.add_train(train, x, y)
+    # stepped rather than updated once, so trains passing through the same cell are caught
+    simulation.run(duration)
+    for i in sorted(simulation.batch.occupancy.take_collisions()):
+        x, y, _, _ = level.trains[i]
+        report['warnings'].append(f'train from {x}, {y} collides with another train')
+    report['simulation_time'] = time.perf_counter() - start
+
+    # the reference loop is the first layout the solver finds for the target
+    target = level.target
+    if target is None:
+        report['warnings'].append('level has no target')
+    elif level.trains:
+        start = time.perf_counter()
+        try:
+            problem = build_problem(level, palette_tiles(_tile_list['tracks.png'], palette), target, tolerance)
+        except ValueError as e:
+            report['problems'].append(str(e))
+        else:
+            solution = search(problem, initial_state(problem), set())
+            if solution is None:
+                report['problems'].append('target cannot be reached with the palette')
+            else:
+                layout = [(problem.cells[cell], tile_id) for cell, tile_id in solution[-1]]
+                score = verify(level, _tile_list['tracks.png'], layout, target, tolerance)
+                if score < 1:
+                    report['problems'].append(f'reference loop only matches the target with score {score:.2f}')
+        report['solve_time'] = time.perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'directory', nargs='?',
+        default=data_dir,
+    )
+    parser.add_argument(
+        '-p', '--palette', type=int, nargs='+',
+        default=list(range(1, 9)),
+        help='ids of the track pieces the reference loop can be built from',
+    )
+    parser.add_argument('-d', '--duration', type=float, default=60.0, help='seconds to simulate each level as loaded')
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    paths = sorted(Path(args.directory).glob('*.tmx'))
+    with ProcessPoolExecutor(args.jobs, initializer=_init_worker) as executor:
+        reports = list(executor.map(
+            partial(validate, palette=args.palette, duration=args.duration, tolerance=args.tolerance),
+            paths,
+        ))
+
+    json.dump(reports, sys.stdout, indent=2)
+    print()
+    sys.exit(1 if any(report['problems'] for report in reports) else 0)